@@ -0,0 +1,172 @@
+# Discord voice channel observer bot
+# Copyright (C) 2022 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse, json, logging, os, platform, resource, subprocess, sys, tempfile, time
+from collections import Counter
+
+import database
+from bench.generator import Workload
+from common import config
+
+# Runs the hot paths of the bot on a synthetic workload without connecting to
+# Discord and prints the timings as JSON, so that they can be compared between
+# commits, e.g. with python -m bench --events 1000000 --output before.json.
+
+def peak_rss():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+class Runner:
+  def __init__(self):
+    self.results = {}
+
+  # Times the function, which returns the number of operations it has done.
+  def time(self, name, func):
+    logging.info(f'Running {name}')
+    start = time.perf_counter()
+    opc = func()
+    seconds = time.perf_counter() - start
+    self.results[name] = {'seconds': round(seconds, 6), 'ops': opc, 'us_per_op': round(seconds / opc * 1e6, 3) if opc else None, 'peak_rss_bytes': peak_rss()}
+    wait_for_rebuild()
+
+def wait_for_rebuild():
+  import report
+  if report.rebuild_thread is not None:
+    report.rebuild_thread.join()
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m bench', description='Benchmarks the bot on a synthetic workload.')
+  parser.add_argument('--events', type=int, default=100_000, help='the number of events in the database')
+  parser.add_argument('--seed', type=int, default=0, help='the seed of the workload')
+  parser.add_argument('--add-events', type=int, default=20_000, help='the number of events to add one by one with database.add_event')
+  parser.add_argument('--batch', type=int, default=1000, help='the size of the batches given to database.add_events')
+  parser.add_argument('--storages', default='json,binary,sqlite,segments', help='the storages to save to and load from, separated by commas')
+  parser.add_argument('--output', help='the file to write the results to instead of the standard output')
+  parser.add_argument('--verbose', action='store_true', help='log what the bot is doing')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+
+  config['comment_cooldown'] = '0s'
+  workload = Workload(args.events, args.seed)
+  runner = Runner()
+  deletes = []
+  types = Counter()
+
+  def ingest():
+    for kind, value in workload:
+      if kind == 'event':
+        database.data['events'].append(value)
+        types[value['type']] += 1
+      else:
+        deletes.append(value)
+    for table in ['guild_names', 'channel_guilds', 'channel_names', 'user_names']:
+      database.data[table].update(getattr(workload, table))
+    return len(database.data['events'])
+  runner.time('generate_workload', ingest)
+
+  def update_cache():
+    database.reset_cache()
+    database.update_cache()
+    return len(database.data['events'])
+  runner.time('database.update_cache', update_cache)
+
+  # The reports are imported only now, so that they don't rebuild their
+  # meetings in the background while the cache is being updated.
+  import report
+
+  def delete_comments():
+    for message in deletes:
+      database.delete_comment(message)
+    return len(deletes)
+  runner.time('database.delete_comment', delete_comments)
+
+  runner.time('report.rebuild', lambda: report.rebuild() or len(database.data['events']))
+
+  channels = sorted(database.data['channel_events'], key=lambda channel: len(database.data['channel_events'][channel]))
+  def get_meetings():
+    for channel in channels:
+      report.get_meetings(channel)
+    return len(channels)
+  runner.time('report.get_meetings', get_meetings)
+
+  def generate():
+    with open(os.devnull, 'w') as file:
+      report.generate(channels[-1], file)
+    return 1
+  runner.time('report.generate', generate)
+
+  def add_events():
+    opc = 0
+    for kind, value in Workload(args.add_events, args.seed + 1):
+      if kind == 'event':
+        del value['time'], value['utcoffset']
+        database.add_event(value)
+        opc += 1
+    return opc
+  runner.time('database.add_event', add_events)
+
+  def add_batches():
+    opc = 0
+    batch = []
+    for kind, value in Workload(args.add_events, args.seed + 2):
+      if kind == 'event':
+        del value['time'], value['utcoffset']
+        batch.append(value)
+        if len(batch) == args.batch:
+          database.add_events(batch)
+          opc += len(batch)
+          batch = []
+    database.add_events(batch)
+    return opc + len(batch)
+  runner.time('database.add_events', add_batches)
+
+  with tempfile.TemporaryDirectory() as directory:
+    for storage in args.storages.split(','):
+      config['storage'] = storage
+      config['database'] = os.path.join(directory, f'database.{storage}')
+      def save():
+        with database.lock:
+          database.open_storage()
+          database.storage.rewrite()
+        return len(database.data['events'])
+      runner.time(f'database.save.{storage}', save)
+      runner.results[f'database.save.{storage}']['bytes'] = database.disk_usage()
+      runner.time(f'database.load.{storage}', lambda: database.load() or len(database.data['events']))
+
+  result = {
+    'commit': get_commit(),
+    'python': sys.version,
+    'platform': platform.platform(),
+    'arguments': vars(args),
+    'events': len(database.data['events']),
+    'event_types': dict(types),
+    'results': runner.results,
+    'peak_rss_bytes': peak_rss(),
+  }
+  text = json.dumps(result, indent=2)
+  if args.output is None:
+    print(text)
+  else:
+    with open(args.output, 'w') as file:
+      file.write(text + '\n')
+
+if __name__ == '__main__':
+  main()
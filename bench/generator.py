@@ -0,0 +1,130 @@
+# Discord voice channel observer bot
+# Copyright (C) 2022 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+from dataclasses import dataclass, field
+
+# A synthetic workload made to look like what the bot sees in Discord: guilds
+# with a few voice channels each, and users who join them, mute and unmute
+# themselves, stream, comment and leave, every now and then in large groups for
+# a meeting. The same seed always gives the same workload.
+
+FLAGS = ['afk', 'mute.user', 'mute.guild', 'deafen.user', 'deafen.guild', 'stream', 'video']
+EPOCH = 1_640_995_200_000_000 # 2022-01-01 in microseconds
+
+@dataclass
+class Workload:
+  eventc: int
+  seed: int = 0
+  channels_per_guild: int = 5
+  users_per_guild: int = 40
+  comment_rate: float = 0.05  # The chance that an event is a comment
+  delete_rate: float = 0.05   # The chance that a comment gets deleted later
+  guild_names: dict = field(default_factory=dict)
+  channel_guilds: dict = field(default_factory=dict)
+  channel_names: dict = field(default_factory=dict)
+  user_names: dict = field(default_factory=dict)
+
+  @property
+  def guildc(self):
+    return max(1, self.eventc // 100_000)
+
+  # Yields ('event', event) and ('delete', message) pairs, where the events
+  # come with their time, as if they had already been added to the database.
+  def __iter__(self):
+    rng = random.Random(self.seed)
+    snowflake = iter(range(10**17, 10**18, 4_194_304))
+    time = EPOCH
+
+    guilds = []
+    for g in range(self.guildc):
+      guild = next(snowflake)
+      self.guild_names[guild] = f'Guild {g}'
+      channels = []
+      for c in range(self.channels_per_guild):
+        channel = next(snowflake)
+        self.channel_guilds[channel] = guild
+        self.channel_names[channel] = f'Channel {c}'
+        channels.append(channel)
+      users = []
+      for u in range(self.users_per_guild):
+        user = next(snowflake)
+        self.user_names[user] = f'user{g}_{u}'
+        users.append(user)
+      guilds.append((guild, channels, users))
+
+    eventc = 0
+    def event(type, guild, **fields):
+      nonlocal eventc
+      eventc += 1
+      return ('event', {'time': time, 'utcoffset': 3600, 'type': type, 'guild': guild, **fields})
+
+    for guild, channels, users in guilds:
+      for channel in channels:
+        yield event('create', guild, channel=channel, cause='scan.bot_ready')
+
+    where = {}
+    states = {}
+    comments = []
+    while eventc < self.eventc:
+      # Activity comes in bursts separated by quiet periods, during which
+      # everybody leaves.
+      if rng.random() < 0.002:
+        for (guild, user), channel in sorted(where.items()):
+          yield event('leave', guild, channel=channel, user=user, cause='event')
+        where.clear()
+        time += rng.randrange(3600, 86400) * 1_000_000
+      time += int(rng.expovariate(1 / 20) * 1_000_000)
+      guild, channels, users = rng.choice(guilds)
+      # Most of the activity happens in the first few channels of a guild.
+      user = rng.choice(users)
+      key = (guild, user)
+
+      if key not in where:
+        channel = channels[min(int(rng.expovariate(1)), len(channels) - 1)]
+        state = {flag for flag in FLAGS[:2] if rng.random() < 0.3}
+        if states.get(key) != state:
+          yield event('user_state', guild, channel=channel, user=user, value=state, cause='event')
+          states[key] = state
+        yield event('join', guild, channel=channel, user=user, cause='event')
+        where[key] = channel
+      else:
+        channel = where[key]
+        r = rng.random()
+        if r < self.comment_rate:
+          message = next(snowflake)
+          content = ' '.join(rng.choice(['yes', 'no', 'maybe', 'brb', 'lol', 'https://example.com/', 'can you hear me?']) for i in range(rng.randrange(1, 12)))
+          yield event('comment', guild, channel=channel, user=user, message_channel=channel, message=message, content=content)
+          if rng.random() < self.delete_rate:
+            comments.append(message)
+        elif r < 0.25:
+          del where[key]
+          yield event('leave', guild, channel=channel, user=user, cause='event')
+        elif r < 0.3:
+          new = rng.choice(channels)
+          if new != channel:
+            yield event('leave', guild, channel=channel, user=user, cause='event')
+            yield event('join', guild, channel=new, user=user, cause='event')
+            where[key] = new
+        else:
+          state = set(states.get(key, set()))
+          state ^= {rng.choice(FLAGS)}
+          state.discard('afk')
+          yield event('user_state', guild, channel=channel, user=user, value=state, cause='event')
+          states[key] = state
+
+      if comments and rng.random() < 0.01:
+        yield ('delete', comments.pop(rng.randrange(len(comments))))
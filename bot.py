@@ -14,10 +14,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import asyncio, discord, io, logging, threading
+import asyncio, discord, logging, threading, time
 from copy import deepcopy
+from datetime import datetime
 
-import console, database, report
+import console, database, report, stats
 from common import config, parse_duration
 
 # IDEA: Transcripts
@@ -29,6 +30,11 @@ start_event = threading.Event()
 stop_event = threading.Event()
 
 def run():
+  if config['shard_ids'] is not None:
+    if config['shard_count'] is None:
+      raise Exception('The shards of this process can only be chosen together with shard_count')
+    if config['shard_count'] == 'auto':
+      raise Exception('The shards of this process can only be chosen with a fixed shard_count, not "auto"')
   start()
   try:
     while True:
@@ -39,7 +45,11 @@ def run():
       intents.message_content = True
 
       global client
-      client = Client(intents=intents)
+      if config['shard_count'] is None:
+        client = Client(intents=intents)
+      else:
+        shard_count = None if config['shard_count'] == 'auto' else config['shard_count']
+        client = ShardedClient(intents=intents, shard_count=shard_count, shard_ids=config['shard_ids'])
       asyncio.run(client.start(config['token'])) # The Client object is useless after this.
       client = None
 
@@ -73,78 +83,115 @@ def voice_state_to_flags(state):
   if state.self_video:  result.add('video')
   return result
 
-class Client(discord.Client):
-  async def scan(self, reason):
-    logging.info(f'Scanning active users and available channels with reason {repr(reason)}')
-
-    self.presence_channelc = 0
-    with database.lock:
-      active_users = deepcopy(database.data['active_users'])
-      available_channels = deepcopy(database.data['available_channels'])
-
-      delayed = []
-      for guild in self.guilds:
-        database.data['guild_names'][guild.id] = guild.name
-
-        for channel in guild.voice_channels:
-          if channel.id in available_channels.get(guild.id, set()):
-            available_channels[guild.id].remove(channel.id)
-          else:
-            delayed.append({
-              'type': 'create',
-              'guild': guild.id,
-              'channel': channel.id,
-              'cause': 'scan.' + reason,
-            })
-          database.data['channel_guilds'][channel.id] = channel.guild.id
-          database.data['channel_names'][channel.id] = channel.name
-          self.presence_channelc += 1
-
-          for member in channel.members:
-            delayed.append({
-              'type': 'user_state',
-              'guild': guild.id,
-              'channel': channel.id,
-              'user': member.id,
-              'value': voice_state_to_flags(member.voice),
-              'cause': 'scan.' + reason,
-            })
-            if member.id in active_users.get(guild.id, {}).get(channel.id, {}):
-              active_users[guild.id][channel.id].remove(member.id)
-            else:
-              delayed.append({
-                'type': 'join',
-                'guild': guild.id,
-                'channel': channel.id,
-                'user': member.id,
-                'cause': 'scan.' + reason,
-              })
-            database.data['user_names'][member.id] = str(member)
-
-      for guild, channels in active_users.items():
-        for channel, users in channels.items():
-          for user in users:
-            database.add_event({
-              'type': 'leave',
-              'guild': guild,
-              'channel': channel,
-              'user': user,
-              'cause': 'scan.' + reason,
-            })
-
-      for guild, channels in available_channels.items():
-        for channel in channels:
-          database.add_event({
-            'type': 'delete',
+# Adds the events which make the database agree with the given voice channels
+# and their members in each guild. Only the guilds in the scope are touched,
+# and the ones missing from guilds are treated as empty. This runs in the
+# database writer.
+def reconcile(guilds, names, cause, now, scope=None):
+  for table, id, name in names:
+    database.set_name(table, id, name)
+
+  if scope is None:
+    active_users = deepcopy(database.data['active_users'])
+    available_channels = deepcopy(database.data['available_channels'])
+  else:
+    active_users = {guild: deepcopy(database.data['active_users'][guild]) for guild in scope if guild in database.data['active_users']}
+    available_channels = {guild: database.data['available_channels'][guild].copy() for guild in scope if guild in database.data['available_channels']}
+
+  delayed = []
+  for guild, channels in guilds.items():
+    for channel, members in channels.items():
+      if channel in available_channels.get(guild, set()):
+        available_channels[guild].remove(channel)
+      else:
+        delayed.append({
+          'type': 'create',
+          'guild': guild,
+          'channel': channel,
+          'cause': cause,
+        })
+
+      for member, flags in members.items():
+        delayed.append({
+          'type': 'user_state',
+          'guild': guild,
+          'channel': channel,
+          'user': member,
+          'value': flags,
+          'cause': cause,
+        })
+        if member in active_users.get(guild, {}).get(channel, {}):
+          active_users[guild][channel].remove(member)
+        else:
+          delayed.append({
+            'type': 'join',
             'guild': guild,
             'channel': channel,
-            'cause': 'scan.' + reason,
+            'user': member,
+            'cause': cause,
           })
 
-      for event in delayed:
-        database.add_event(event)
+  batch = []
+  for guild, channels in active_users.items():
+    for channel, users in channels.items():
+      for user in users:
+        batch.append({
+          'type': 'leave',
+          'guild': guild,
+          'channel': channel,
+          'user': user,
+          'cause': cause,
+        })
+
+  for guild, channels in available_channels.items():
+    for channel in channels:
+      batch.append({
+        'type': 'delete',
+        'guild': guild,
+        'channel': channel,
+        'cause': cause,
+      })
 
-      database.should_save = True
+  database.add_events(batch + delayed, now)
+  database.should_save = True
+
+class Client(discord.Client):
+  report_jobc = 0
+
+  # Scans either all guilds or only the given ones, which are treated as empty
+  # if the bot isn't in them anymore.
+  @stats.timed('bot.scan')
+  async def scan(self, reason, only=None):
+    if only is None:
+      logging.info(f'Scanning active users and available channels with reason {repr(reason)}')
+    else:
+      logging.info(f'Scanning active users and available channels in {len(only)} guilds with reason {repr(reason)}')
+    start = time.perf_counter()
+
+    # The state of the guilds is read here on the event loop, while the
+    # database is brought in line with it by the writer.
+    self.presence_channelc = sum(len(guild.voice_channels) for guild in self.guilds)
+    scope = None
+    scanned = self.guilds
+    if only is not None:
+      scope = {guild.id for guild in only}
+      scanned = [guild for guild in only if self.get_guild(guild.id) is not None]
+    guilds = {}
+    names = []
+    for guild in scanned:
+      names.append(('guild_names', guild.id, guild.name))
+      channels = guilds[guild.id] = {}
+      for channel in guild.voice_channels:
+        names.append(('channel_guilds', channel.id, channel.guild.id))
+        names.append(('channel_names', channel.id, channel.name))
+        members = channels[channel.id] = {}
+        for member in channel.members:
+          members[member.id] = voice_state_to_flags(member.voice)
+          names.append(('user_names', member.id, str(member)))
+
+    now = datetime.now().astimezone()
+    await asyncio.wrap_future(database.submit(reconcile, guilds, names, 'scan.' + reason, now, scope))
+    logging.info(f'Finished scanning in {time.perf_counter() - start:.3f} seconds')
 
     await self.update_presence()
 
@@ -157,8 +204,7 @@ class Client(discord.Client):
     await self.scan('bot_ready')
 
   async def on_voice_state_update(self, member, before, after):
-    database.data['user_names'][member.id] = str(member)
-    database.should_save = True
+    database.submit(database.set_name, 'user_names', member.id, str(member))
 
     event = {
       'type': None,
@@ -172,7 +218,7 @@ class Client(discord.Client):
       event['type'] = 'leave'
       event['guild'] = before.channel.guild.id
       event['channel'] = before.channel.id
-      database.add_event(event)
+      database.submit_event(event)
       return
 
     user_state_event = {
@@ -185,32 +231,25 @@ class Client(discord.Client):
     }
 
     if before.channel != after.channel:
+      batch = []
       if before.channel is not None:
-        event['type'] = 'leave'
-        event['guild'] = before.channel.guild.id
-        event['channel'] = before.channel.id
-        database.add_event(event)
-
-      database.add_event(user_state_event)
-
-      event['type'] = 'join'
-      event['guild'] = after.channel.guild.id
-      event['channel'] = after.channel.id
-      database.add_event(event)
+        batch.append(event | {'type': 'leave', 'guild': before.channel.guild.id, 'channel': before.channel.id})
+      batch.append(user_state_event)
+      batch.append(event | {'type': 'join', 'guild': after.channel.guild.id, 'channel': after.channel.id})
+      database.submit_events(batch)
     else:
-      database.add_event(user_state_event)
+      database.submit_event(user_state_event)
 
   async def on_guild_channel_create(self, channel):
     if isinstance(channel, discord.VoiceChannel):
-      database.add_event({
+      database.submit_event({
         'type': 'create',
         'guild': channel.guild.id,
         'channel': channel.id,
         'cause': 'event',
       })
-      database.data['channel_guilds'][channel.id] = channel.guild.id
-      database.data['channel_names'][channel.id] = channel.name
-      database.should_save = True
+      database.submit(database.set_name, 'channel_guilds', channel.id, channel.guild.id)
+      database.submit(database.set_name, 'channel_names', channel.id, channel.name)
 
       self.presence_channelc += 1
       await self.update_presence()
@@ -220,7 +259,7 @@ class Client(discord.Client):
       # Ideally, we'd like to know when leave events are caused by channel
       # deletion. Discord unfortunately doesn't provide us with such information,
       # so we would have to set recent leave events' causes to event.delete here.
-      database.add_event({
+      database.submit_event({
         'type': 'delete',
         'guild': channel.guild.id,
         'channel': channel.id,
@@ -232,18 +271,16 @@ class Client(discord.Client):
 
   async def on_guild_channel_update(self, before, after):
     if isinstance(after, discord.VoiceChannel):
-      database.data['channel_names'][after.id] = after.name
-      database.should_save = True
+      database.submit(database.set_name, 'channel_names', after.id, after.name)
 
   async def on_guild_join(self, guild):
-    await self.scan('guild')
+    await self.scan('guild', [guild])
 
   async def on_guild_remove(self, guild):
-    await self.scan('guild')
+    await self.scan('guild', [guild])
 
   async def on_guild_update(self, before, after):
-    database.data['guild_names'][after.id] = after.name
-    database.should_save = True
+    database.submit(database.set_name, 'guild_names', after.id, after.name)
 
   async def on_message(self, message):
     if message.author == self.user:
@@ -257,27 +294,53 @@ class Client(discord.Client):
 
     # IDEA: Recognize natural language questions
     report_channel = None
+    report_range = None, None
     if not content and isinstance(message.channel, discord.VoiceChannel):
       report_channel = message.channel.id
-    elif content.startswith('<#') and content.endswith('>'):
-      inside = content.removeprefix('<#').removesuffix('>')
+    elif content.startswith('<#') and '>' in content:
+      inside, _, rest = content.removeprefix('<#').partition('>')
       if inside == inside.strip().lstrip('+-'):
         try:
           report_channel = int(inside)
         except ValueError:
           pass
+        else:
+          try:
+            report_range = report.parse_range(rest)
+          except Exception:
+            await message.add_reaction('❌')
+            return
 
     if report_channel is not None:
       channel = self.get_channel(report_channel)
-      if channel is not None and channel.permissions_for(message.author).view_channel:
-        with io.StringIO(report.generate(report_channel)) as file:
-          await message.reply(file=discord.File(file, 'report.html'))
-      else:
+      if channel is None or not channel.permissions_for(message.author).view_channel:
         await message.add_reaction('❓')
+      elif self.report_jobc >= int(config['report_queue']):
+        await message.add_reaction('⏳')
+      else:
+        limit = int(config['report_upload_limit'])
+        if message.guild is not None:
+          limit = message.guild.filesize_limit
+
+        self.report_jobc += 1
+        try:
+          attachment = await asyncio.get_running_loop().run_in_executor(report.get_executor(), report.get_attachment, report_channel, limit, *report_range)
+        finally:
+          self.report_jobc -= 1
+
+        if attachment is None:
+          await message.add_reaction('❌')
+        else:
+          file, name, window = attachment
+          with file:
+            if window is None:
+              await message.reply(file=discord.File(file, name))
+            else:
+              await message.reply(f'The full report is too big to be uploaded, so this one covers only the last {window}.', file=discord.File(file, name))
 
     elif content and isinstance(message.author, discord.Member) and message.author.voice is not None:
       try:
-        database.add_event({
+        await asyncio.wrap_future(database.submit_event({
           'type': 'comment',
           'guild': message.guild.id,
           'channel': message.author.voice.channel.id,
@@ -285,7 +348,7 @@ class Client(discord.Client):
           'message_channel': message.channel.id,
           'message': message.id,
           'content': content,
-        })
+        }))
       except database.Throttled:
         await message.add_reaction('⏳')
       else:
@@ -298,7 +361,7 @@ I'm a Discord bot that monitors activity in voice channels on this server. To ge
 - mention me in that voice channel's chat,
 - DM me the voice channel's mention, or
 - mention me and then the voice channel in the same message in any channel.
-To mention a voice channel you have to copy its ID and put it inside `<#` and `>`. You can also comment on an ongoing meeting as one of its participants by mentioning me and then writing the comment's contents in the same message. Please note that everyone's ability to submit comments is limited to once every {parse_duration(config['comment_cooldown'])} seconds.
+To mention a voice channel you have to copy its ID and put it inside `<#` and `>`. You can limit the report to a time range by writing e.g. `7d`, `from 30d to 7d` or `from 2022-08-01 to 2022-09-01` after the mention. You can also comment on an ongoing meeting as one of its participants by mentioning me and then writing the comment's contents in the same message. Please note that everyone's ability to submit comments is limited to once every {parse_duration(config['comment_cooldown'])} seconds.
 
 Please direct all questions and feedback to my author's DMs - digitcrusher#8454. I'm licensed under the AGPL-3.0-or-later and you can view my original source code on https://github.com/digitcrusher/Discord-voice-channel-observer-bot''', suppress_embeds=True)
 
@@ -307,14 +370,23 @@ Please direct all questions and feedback to my author's DMs - digitcrusher#8454.
 
   async def on_raw_message_edit(self, payload):
     content = payload.data.get('content', '').lstrip().removeprefix(f'<@{self.user.id}>').strip()
-    database.edit_comment(payload.message_id, content)
+    database.submit(database.edit_comment, payload.message_id, content)
 
   async def on_raw_message_delete(self, payload):
-    database.delete_comment(payload.message_id)
+    database.submit(database.delete_comment, payload.message_id)
 
   async def on_raw_message_bulk_delete(self, payload):
     for message in payload.message_ids:
-      database.delete_comment(message)
+      database.submit(database.delete_comment, message)
+
+# Discord requires bots in many guilds to split their gateway connection into
+# shards, each of which handles a part of the guilds.
+class ShardedClient(Client, discord.AutoShardedClient):
+  async def on_shard_ready(self, shard_id):
+    # The whole bot is scanned once all shards are ready for the first time, so
+    # this only matters for shards which connect again later on.
+    if self.is_ready():
+      await self.scan('shard_ready', [guild for guild in self.guilds if guild.shard_id == shard_id])
 
 console.begin('bot')
 console.register('start', None, 'starts the bot',                            start)
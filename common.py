@@ -22,15 +22,38 @@ options = {
 
 config = {
   'token': None,                                         # Your Discord bot's token
+  'shard_count': None,                                   # The number of shards the bot connects to Discord with, "auto" to let Discord decide or null not to shard
+  'shard_ids': None,                                     # The shards this process connects with when they are split between processes, or null for all of them
+  'partitions': [],                                      # The paths to the SQLite databases of the processes running the other shards, whose events are merged into reports
   'database': 'database.json',                           # The path to the database file
+  'storage': 'json',                                     # The format the database is saved in, either "json", "binary", "sqlite" or "segments"
+  'segment_months': 1,                                   # The number of months of events kept in each segment file of the segment storage
+  'segment_cache': 4,                                    # The number of segments whose comments are kept decoded in memory at a time
   'autosave': '1m',                                      # The regular time interval at which the database will be automatically saved if needed
+  'journal': True,                                       # Whether autosaves should only append the latest changes to the database journal instead of rewriting the whole database in the JSON storage
+  'compaction': '1d',                                    # The regular time interval at which the journal will be merged into the database file or the database cache will be saved
+  'clean_threshold': 1000,                               # The number of deleted comments above which the database will be cleaned in the background
+  'clean_chunk': 10000,                                  # The number of events copied at a time while cleaning the database in the background
+  'stats': True,                                         # Whether performance statistics should be collected for the console
   'console_host': 'localhost',                           # These two are very much self-explanatory
   'console_port': 4123,
   'console_hello': 'Discord voice channel observer bot', # The name that will be displayed in "… says hello!" after connecting to the console
   'console_timeout': '1m',                               # The time after the last received command after which the connection to the console will be automatically closed
+  'metrics_host': 'localhost',                           # The address and port of the HTTP endpoint serving metrics in the Prometheus text format at /metrics, which is disabled if the port is null
+  'metrics_port': None,
   'meeting_interval': '5m',                              # The minimum time interval after the last user has left a channel required for a user joining to be considered the start of a new meeting
   'meeting_userc': 2,                                    # The minimum number of participants required for a meeting to be included in a report
   'comment_cooldown': '1m',                              # The time a user has to wait to be able to submit a comment again
+  'report_workers': 2,                                   # The number of reports that can be generated at the same time
+  'report_pool': 'thread',                               # Whether reports are rendered in threads ("thread") or in separate processes ("process")
+  'report_queue': 8,                                     # The maximum number of reports waiting to be generated, above which the bot will refuse requests
+  'report_compression': 'zip',                           # The format of compressed reports, either "zip" or "gzip"
+  'report_compression_threshold': 1024 * 1024,           # The size in bytes above which reports are compressed before being uploaded
+  'report_upload_limit': 8 * 1024 * 1024,                # The maximum size in bytes of uploaded files outside of guilds
+  'report_windows': ['90d', '30d', '7d', '1d'],          # The time windows that reports too big to be uploaded are cut down to, tried in order
+  'report_cache_size': 64 * 1024 * 1024,                 # The maximum total size in bytes of reports kept in the report cache
+  'report_cache_ttl': '10s',                             # The time after which a cached report of a channel with a meeting going on is generated again
+  'report_time_rounding': '1h',                          # The time that report ranges and windows relative to now are rounded down to a multiple of, so that repeated requests are found in the report cache
 }
 
 def load_config():
@@ -14,26 +14,35 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json, logging, pprint, socket, threading, time, traceback, typing as ty
+import asyncio, contextvars, json, logging, pprint, threading, traceback, typing as ty
 from dataclasses import dataclass
 
 import common
 from common import config, parse_duration
 
+# The console runs its own event loop in a separate thread, where every
+# connection gets its own session, and the operations themselves are run in a
+# thread pool, so that neither an idle connection nor a slow operation holds up
+# the others.
+loop = None
 server = None
 thread = None
-should_stop_listen = False
-should_stop_conn = False
+sessions = set()
+
+@dataclass(eq=False)
+class Session:
+  addr: str
+  task: asyncio.Task
+  should_stop: bool = False
+  should_restart: bool = False
+
+session = contextvars.ContextVar('session')
 
 def start():
-  global server
-  server = socket.socket()
-  server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-  server.bind((config['console_host'], config['console_port']))
-  server.listen(1)
-
-  global thread
-  thread = threading.Thread(target=listen)
+  global loop, server, thread
+  loop = asyncio.new_event_loop()
+  server = loop.run_until_complete(asyncio.start_server(serve, config['console_host'], config['console_port'], reuse_address=True))
+  thread = threading.Thread(target=loop.run_forever)
   thread.start()
 
   logging.info(f'Started console on {config["console_host"]}:{config["console_port"]}')
@@ -41,108 +50,109 @@ def start():
 def stop():
   logging.info('Stopping console')
 
-  global should_stop_listen, should_stop_conn
-  should_stop_listen = True
-  should_stop_conn = True
-
-  if client is not None:
-    # This will cancel a pending client.recv(). We can still send data to the
-    # client after this because this closes the socket only for incoming data.
-    client.shutdown(socket.SHUT_RD)
-  server.shutdown(socket.SHUT_RDWR) # This will cancel a pending server.accept().
-  if threading.current_thread() != thread: # console.restart also uses this function and we obviously can't thread.join() ourselves there.
-    thread.join()
-  server.close()
-
-client = None
-
-def listen():
-  global should_stop_listen
-  should_stop_listen = False
-  while not should_stop_listen:
-    try:
-      global client
-      (client, addr) = server.accept()
-    except OSError:
-      continue # We probably got cancelled by stop().
-
-    logging.info(f'Console accepted connection from {addr[0]}:{addr[1]}')
+  async def shutdown():
+    server.close()
+    tasks = [session.task for session in sessions]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await server.wait_closed()
+  asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+  loop.call_soon_threadsafe(loop.stop)
+  thread.join()
+  loop.close()
+
+async def serve(reader, writer):
+  addr = '{}:{}'.format(*writer.get_extra_info('peername'))
+  current = Session(addr, asyncio.current_task())
+  session.set(current)
+  sessions.add(current)
+  logging.info(f'Console accepted connection from {addr}')
+
+  async def send(text):
     try:
-      client.send(f'{config["console_hello"]} says hello!\n'.encode())
-      client.send('Type "help" to get a list of available operations.\n'.encode())
-    except BrokenPipeError:
+      writer.write(text.encode())
+      await writer.drain()
+    except ConnectionError:
       pass
 
-    is_client_gone = False
+  is_client_gone = False
+  try:
+    await send(f'{config["console_hello"]} says hello!\n')
+    await send('Type "help" to get a list of available operations.\n')
 
-    global should_stop_conn
-    should_stop_conn = False
-    while not should_stop_conn:
-      try:
-        client.send(b'> ')
-      except BrokenPipeError:
-        pass
+    while not current.should_stop:
+      await send('> ')
 
       timeout = parse_duration(config['console_timeout'])
-      client.settimeout(timeout)
       try:
-        chunk = client.recv(4096)
-      except TimeoutError:
-        client.send(f'\nTimed out after {timeout} seconds.\n'.encode())
+        line = await asyncio.wait_for(reader.read(4096), timeout)
+        # Long commands may come in several chunks, and the rest of a line is
+        # waited for no longer than the line itself.
+        while line and line != b'\x04' and not line.endswith(b'\n'):
+          chunk = await asyncio.wait_for(reader.read(4096), timeout)
+          if not chunk:
+            break
+          line += chunk
+      except asyncio.TimeoutError:
+        await send(f'\nTimed out after {timeout} seconds.\n')
         break
+      except ConnectionError:
+        line = b''
 
-      if not chunk:
-        if should_stop_listen: # This is how we know we got cancelled by stop().
-          client.send(b'\nI have to go, bye.\n')
-        else:
-          is_client_gone = True
-          try:
-            client.send(b'\nThe connection got closed without a goodbye. How rude!\n')
-          except BrokenPipeError:
-            pass
+      if not line:
+        is_client_gone = True
+        await send('\nThe connection got closed without a goodbye. How rude!\n')
         break
-      elif chunk == b'\x04':
-        client.send(b'\nGot end of transmission without a goodbye. How rude!\n')
+      elif line == b'\x04':
+        await send('\nGot end of transmission without a goodbye. How rude!\n')
         break
 
-      line = bytearray(chunk)
-      client.setblocking(False)
-      try:
-        while chunk := client.recv(4096):
-          line += chunk
-      except BlockingIOError: # There is nothing left to receive.
-        pass
-
       try:
         line = line.decode()
       except Exception as e:
         logging.exception('Got exception while decoding console command')
-        client.send(''.join(traceback.format_exception(None, e, e.__traceback__)).encode())
+        await send(''.join(traceback.format_exception(None, e, e.__traceback__)))
         continue
 
-      logging.info(f'Console received command {repr(line)}')
-
-      try:
-        reply = run(line)
-        if reply is not None and not isinstance(reply, str):
-          reply = pprint.pformat(reply, sort_dicts=False)
-      except Exception as e:
-        logging.exception('Got exception while running console command')
-        reply = ''.join(traceback.format_exception(None, e, e.__traceback__))
+      logging.info(f'Console received command {repr(line)} from {addr}')
 
+      reply = await asyncio.to_thread(run_reply, line)
       if reply is not None:
-        client.send(reply.encode())
         if not reply.endswith('\n'):
-          client.send(b'\n')
-
-    try: # We don't want any exceptions here because that would kill our thread and the whole console.
-      if not is_client_gone: # Calling shutdown() on a socket closed by the client would raise an exception.
-        client.shutdown(socket.SHUT_RDWR)
-      client.close()
+          reply += '\n'
+        await send(reply)
+
+  except asyncio.CancelledError: # This is how we know we got cancelled by stop().
+    await send('\nI have to go, bye.\n')
+
+  finally:
+    sessions.discard(current)
+    try: # We don't want any exceptions here because that would kill the whole console.
+      if not is_client_gone:
+        writer.close()
+        await writer.wait_closed()
     except:
       logging.exception('Got exception while closing console connection')
-    client = None
-    logging.info('Console connection closed')
+    logging.info(f'Console connection from {addr} closed')
+
+  if current.should_restart:
+    # stop() waits for all sessions, including this one, to finish.
+    threading.Thread(target=restart).start()
+
+def run_reply(line):
+  try:
+    reply = run(line)
+    if reply is not None and not isinstance(reply, str):
+      reply = pprint.pformat(reply, sort_dicts=False)
+    return reply
+  except Exception as e:
+    logging.exception('Got exception while running console command')
+    return ''.join(traceback.format_exception(None, e, e.__traceback__))
+
+def restart():
+  stop()
+  start()
 
 @dataclass
 class Operation:
@@ -218,21 +228,13 @@ def op_help():
   return result
 
 def op_bye():
-  global should_stop_conn
-  should_stop_conn = True
+  session.get().should_stop = True
   return 'Goodbye!'
 
 def op_restart():
-  stop()
-  # We have to delay the start() because otherwise it would override client and
-  # should_stop_listen and we wouldn't be able to properly clean up and return
-  # from listen().
-  def target():
-    while client is not None:
-      time.sleep(0.1)
-    start()
-  delayed_start = threading.Thread(target=target)
-  delayed_start.start()
+  current = session.get()
+  current.should_stop = True
+  current.should_restart = True
   return 'Restarting the console...'
 
 register('help',    None, 'prints this help message', op_help)
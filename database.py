@@ -14,19 +14,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json, logging, os, threading
-from datetime import datetime
+import json, logging, marshal, os, queue, sqlite3, threading, time, uuid
+from array import array
+from bisect import bisect_left
+from collections import ChainMap
+from concurrent.futures import Future
+from datetime import datetime, timezone
 
-import console
+import console, events, stats
 from common import config, parse_duration
 
 data = {
-  'events': [],
+  'events': events.EventStore(),
   'active_users': {},
   'available_channels': {},
   'message_to_event': {},
   'user_last_comment_times': {},
   'user_states': {},
+  'channel_events': {},
+  'user_state_events': None,
   'cache_eventc': 0,
   'guild_names': {},
   'channel_guilds': {},
@@ -34,61 +40,781 @@ data = {
   'user_names': {},
 }
 should_save = False
-lock = threading.RLock()
+last_save = None
+lock = stats.TimedLock(threading.RLock(), 'database.lock')
+# This is incremented every time the whole database is replaced, which
+# invalidates everything built from it.
+generation = 0
+# This is incremented every time the events are moved around.
+remapc = 0
+# These are called with the index of every event that gets cached and the event.
+cache_listeners = []
+# These are called with the old and new number of cached events every time the
+# events are moved around.
+remap_listeners = []
+# This is incremented every time an event concerning a channel's activity is
+# added, edited or deleted.
+channel_versions = {}
 
-def load():
-  logging.info('Loading database')
-  with lock:
+def object_hook(object):
+  if '__set__' in object:
+    result = set()
+    for item in object:
+      if item != '__set__':
+        try:
+          result.add(int(item))
+        except ValueError:
+          result.add(item)
+    return result
+  else:
+    result = {}
+    for key, value in object.items():
+      try:
+        result[int(key)] = value
+      except ValueError:
+        result[key] = value
+    return result
+
+class Encoder(json.JSONEncoder):
+  def default(self, value):
+    if isinstance(value, events.EventStore):
+      return list(value)
+    elif isinstance(value, events.Row):
+      return dict(value)
+    elif isinstance(value, set):
+      result = {'__set__': True}
+      for item in value:
+        result[item] = None
+      return result
+    return json.JSONEncoder.default(self, value)
+
+# Every change to the database is also written down as one compact record in
+# pending and handed over to the storage on save, so that the storage doesn't
+# have to rewrite the whole database every time.
+pending = []
+should_compact = False
+last_compaction = time.monotonic()
+
+def record(*entry):
+  pending.append(entry)
+
+# Everything derived from the events is saved separately as a snapshot along
+# with the number of events it reflects, so that loading the database only
+# requires caching the events after that. It's only ever read back by the same
+# bot, so it's saved with marshal, which is a lot faster to load than JSON. The
+# version has to be bumped every time the cache changes its meaning.
+CACHE_VERSION = 3
+CACHE_KEYS = [
+  'active_users',
+  'available_channels',
+  'message_to_event',
+  'user_last_comment_times',
+  'user_states',
+  'channel_events',
+  'user_state_events',
+  'cache_eventc',
+]
+
+# Other modules can save their own state derived from the events along with the
+# cache, under a name, with a function returning something marshallable, which
+# is called under the lock, and another one taking it back on load or getting
+# None if there's nothing to restore.
+cache_extensions = {}
+
+def cache_path():
+  return config['database'] + '.cache'
+
+# The event indices are kept in arrays, which marshal can't save by themselves.
+INDEX_KEYS = ['channel_events', 'user_state_events']
+
+def pack_indices(indices):
+  return None if indices is None else {id: ids.tobytes() for id, ids in indices.items()}
+
+def unpack_indices(packed):
+  if packed is None:
+    return None
+  result = {}
+  for id, ids in packed.items():
+    result[id] = array('q')
+    result[id].frombytes(ids)
+  return result
+
+def dump_cache(snapshot):
+  cache = {key: data[key] for key in CACHE_KEYS}
+  for key in INDEX_KEYS:
+    cache[key] = pack_indices(data[key])
+  cache['extensions'] = {name: dump() for name, (dump, restore) in cache_extensions.items()}
+  cache['snapshot'] = snapshot
+  cache['version'] = (CACHE_VERSION, marshal.version)
+  return marshal.dumps(cache)
+
+def write_cache(cache):
+  replace_file(cache_path(), lambda file: file.write(cache))
+
+def save_cache(snapshot):
+  write_cache(dump_cache(snapshot))
+
+def load_cache(snapshot):
+  try:
+    with open(cache_path(), 'rb') as file:
+      cache = marshal.load(file)
+    if snapshot is None or cache['snapshot'] != snapshot or cache['version'] != (CACHE_VERSION, marshal.version):
+      logging.info('Ignoring outdated database cache')
+    else:
+      for key in CACHE_KEYS:
+        data[key] = cache[key]
+      for key in INDEX_KEYS:
+        data[key] = unpack_indices(cache[key])
+      for name, (dump, restore) in cache_extensions.items():
+        restore(cache['extensions'].get(name, None))
+  except (FileNotFoundError, EOFError, ValueError, TypeError):
+    pass
+
+# Writes the file through a temporary one, which is flushed to disk before it's
+# renamed over the old one, so that a crash leaves either the old or the new
+# file behind and never a partial one. The old file can be kept around under
+# another name as well.
+def replace_file(path, write, mode='wb', keep_old=False):
+  with open(path + '.new', mode) as file:
+    write(file)
+    file.flush()
+    os.fsync(file.fileno())
+  if keep_old and os.path.exists(path):
+    if os.path.exists(path + '.old'):
+      os.remove(path + '.old')
+    os.link(path, path + '.old')
+  os.replace(path + '.new', path)
+  # The rename itself only survives a crash once the directory is on disk.
+  directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+  try:
+    os.fsync(directory)
+  finally:
+    os.close(directory)
+
+# A point in time of the database, which is quick to take under the lock and
+# can be written out without it. The events are append-only, so only their
+# number is taken, while the small tables and the cache are copied.
+class Snapshot:
+  def __init__(self, records, with_cache=True):
+    self.id = str(uuid.uuid4())
+    self.records = records
+    self.store = data['events']
+    self.eventc = len(self.store)
+    self.tables = {key: value.copy() for key, value in data.items() if key not in CACHE_KEYS and key != 'events'}
+    self.cache = dump_cache(self.id) if with_cache else None
+
+# The JSON storage keeps the whole database in one file, which is only rewritten
+# during compaction, and appends the records in between to a journal file.
+class JsonStorage:
+  def __init__(self, path):
+    self.path = path
+    self.snapshot = None
+
+  def journal_path(self):
+    return self.path + '.journal'
+
+  # Loads everything but the cache into data and returns the snapshot the cache
+  # has to match.
+  def load(self):
     try:
-      def object_hook(object):
-        if '__set__' in object:
-          result = set()
-          for item in object:
-            if item != '__set__':
-              try:
-                result.add(int(item))
-              except ValueError:
-                result.add(item)
-          return result
-        else:
-          result = {}
-          for key, value in object.items():
-            try:
-              result[int(key)] = value
-            except ValueError:
-              result[key] = value
-          return result
-      with open(config['database'], 'r') as file:
+      with open(self.path, 'r') as file:
         loaded = json.load(file, object_hook=object_hook)
+    except FileNotFoundError:
+      return None
+    snapshot = self.snapshot = loaded.pop('snapshot', None)
+    for key in CACHE_KEYS: # Databases used to be saved together with their cache.
+      loaded.pop(key, None)
+    data.update(loaded)
+    data['events'] = events.EventStore(loaded['events'])
+    return snapshot
 
-      data.update(loaded)
-      global should_save
-      should_save = False
+  def replay(self):
+    recordc = 0
+    try:
+      with open(self.journal_path(), 'r') as file:
+        for line in file:
+          try:
+            entry = json.loads(line, object_hook=object_hook)
+          except ValueError:
+            # We most likely crashed in the middle of appending to the journal.
+            logging.warning(f'Ignoring incomplete journal record: {repr(line)}')
+            break
+          # Journals start with the snapshot they were started after, so that
+          # one left behind by a crash during compaction isn't replayed twice.
+          if entry[0] == 'snapshot':
+            if entry[1] != self.snapshot:
+              logging.warning('Ignoring database journal from before the last compaction')
+              break
+            continue
+          replay(entry)
+          recordc += 1
     except FileNotFoundError:
       pass
+    return recordc
+
+  def is_due(self):
+    return not config['journal'] or not os.path.exists(self.path) or \
+           time.monotonic() - last_compaction >= parse_duration(config['compaction'])
+
+  def append(self, records):
+    logging.info(f'Appending {len(records)} records to the database journal')
+    is_new = not os.path.exists(self.journal_path())
+    with open(self.journal_path(), 'a') as file:
+      # Databases from before snapshots had IDs are started with a null one,
+      # which no compaction will ever match again.
+      if is_new:
+        file.write(json.dumps(['snapshot', self.snapshot]) + '\n')
+      file.writelines(json.dumps(entry, cls=Encoder, separators=(',', ':')) + '\n' for entry in records)
+      file.flush()
+      os.fsync(file.fileno())
+
+  # This is called under the lock.
+  # The events are encoded from a frozen copy, which has to agree with the
+  # cache taken along with it.
+  def take_snapshot(self, records):
+    snapshot = Snapshot(records)
+    snapshot.store = snapshot.store.frozen_copy()
+    return snapshot
+
+  # The records don't matter here, because the whole database is rewritten.
+  def compact(self, snapshot):
+    self.write(snapshot)
+    write_cache(snapshot.cache)
+    self.snapshot = snapshot.id
+
+    # The journal is only ever replayed on top of the database file it was
+    # started after.
+    if os.path.exists(self.journal_path()):
+      os.remove(self.journal_path())
+
+  # The events are encoded in chunks, so that they are never all in memory as
+  # JSON at once.
+  def write(self, snapshot):
+    def write(file):
+      file.write(f'{{"snapshot":{json.dumps(snapshot.id)},"events":[')
+      for begin in range(0, snapshot.eventc, 1000):
+        chunk = json.dumps([snapshot.store[i] for i in range(begin, min(begin + 1000, snapshot.eventc))], cls=Encoder, separators=(',', ':'))
+        file.write((',' if begin > 0 else '') + chunk[1:-1])
+      file.write(']')
+      for key, value in snapshot.tables.items():
+        file.write(f',{json.dumps(key)}:{json.dumps(value, cls=Encoder)}')
+      file.write('}')
+    replace_file(self.path, write, 'w', keep_old=True)
+
+  def rewrite(self):
+    self.compact(self.take_snapshot([]))
+
+  def close(self):
+    pass
+
+# The binary storage keeps the whole database in one file and a journal like the
+# JSON storage, but the file holds the columns of the events as they are in
+# memory and everything else marshalled, so that loading it doesn't have to
+# parse every event and guess the types of the keys of every table.
+class BinaryStorage(JsonStorage):
+  MAGIC = b'VCOBSNP1'
+  VERSION = 1
+
+  def load(self):
+    try:
+      with open(self.path, 'rb') as file:
+        if file.read(len(self.MAGIC)) != self.MAGIC:
+          raise Exception(f'Not a binary database: {repr(self.path)}')
+        saved = marshal.load(file)
+    except FileNotFoundError:
+      return None
+    if saved['version'] != self.VERSION:
+      raise Exception(f'Unsupported binary database version: {repr(saved["version"])}')
+    data.update(saved['tables'])
+
+    store = events.EventStore()
+    for name, values in saved['interned'].items():
+      interned = getattr(store, name)
+      interned.values = values
+      interned.codes = {value: code for code, value in enumerate(values)}
+    for name, code in events.COLUMNS:
+      getattr(store, name).frombytes(saved['columns'][name])
+    store.extras = saved['extras']
+    store.count_tombstones()
+    data['events'] = store
+    self.snapshot = saved['snapshot']
+    return self.snapshot
+
+  # The columns and the list of extra fields are copied as they are, which is
+  # a lot quicker than going through the events one by one.
+  def take_snapshot(self, records):
+    snapshot = Snapshot(records)
+    store = snapshot.store
+    if store.base > 0: # The events were loaded from segments.
+      store = events.EventStore(store)
+    snapshot.columns = {name: store.active(name).tobytes() for name, code in events.COLUMNS}
+    snapshot.extras = store.extras.copy()
+    snapshot.interned = {name: getattr(store, name).values.copy() for name in ['ids', 'types', 'causes', 'flags']}
+    return snapshot
+
+  def write(self, snapshot):
+    saved = {
+      'version': self.VERSION,
+      'snapshot': snapshot.id,
+      'tables': snapshot.tables,
+      'interned': snapshot.interned,
+      'columns': snapshot.columns,
+      'extras': snapshot.extras,
+    }
+    def write(file):
+      file.write(self.MAGIC)
+      marshal.dump(saved, file)
+    replace_file(self.path, write, keep_old=True)
+
+# The SQLite storage keeps one row per event, which lets records be written
+# right away in one transaction per save instead of rewriting the whole
+# database, and lets the database be queried by other programs. Deleted
+# comments are deleted from the table, so the events are numbered like in a
+# cleaned database, and the cache is only valid as long as nothing has been
+# deleted since it was saved.
+class SqliteStorage:
+  NAME_TABLES = ['guild_names', 'channel_guilds', 'channel_names', 'user_names']
+  COLUMNS = 'time, utcoffset, type, guild, channel, user, value, cause, message, extra'
+
+  def __init__(self, path):
+    self.path = path
+    # This is set when a compaction had to leave the cache for later, because
+    # the deleted comments were still being cleaned.
+    self.is_cache_deferred = False
+    self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self.connection.execute('PRAGMA journal_mode = WAL')
+    self.connection.execute('PRAGMA synchronous = NORMAL')
+    with self.connection:
+      self.connection.execute('BEGIN')
+      self.connection.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+          id INTEGER PRIMARY KEY,
+          time INTEGER NOT NULL,
+          utcoffset INTEGER NOT NULL,
+          type TEXT NOT NULL,
+          guild INTEGER,
+          channel INTEGER,
+          user INTEGER,
+          value TEXT,
+          cause TEXT,
+          message INTEGER,
+          extra TEXT
+        )
+      ''')
+      self.connection.execute('CREATE INDEX IF NOT EXISTS events_channel_time ON events (channel, time)')
+      self.connection.execute('CREATE INDEX IF NOT EXISTS events_user_time ON events (user, time)')
+      self.connection.execute('CREATE INDEX IF NOT EXISTS events_message ON events (message)')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS names ("table" TEXT, id INTEGER, name TEXT, PRIMARY KEY ("table", id))')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+  @staticmethod
+  def to_row(event):
+    extra = {key: value for key, value in event.items() if key not in events.FIELDS and key != 'message'}
+    return (
+      event['time'], event['utcoffset'], event['type'],
+      event.get('guild', None), event.get('channel', None), event.get('user', None),
+      json.dumps(sorted(event['value'])) if 'value' in event else None,
+      event.get('cause', None), event.get('message', None),
+      json.dumps(extra) if extra else None,
+    )
+
+  @staticmethod
+  def from_row(row):
+    time, utcoffset, type, guild, channel, user, value, cause, message, extra = row
+    event = {'time': time, 'utcoffset': utcoffset, 'type': type}
+    for key, item in [('guild', guild), ('channel', channel), ('user', user)]:
+      if item is not None:
+        event[key] = item
+    if value is not None:
+      event['value'] = set(json.loads(value))
+    if cause is not None:
+      event['cause'] = cause
+    if message is not None:
+      event['message'] = message
+    if extra is not None:
+      event.update(json.loads(extra))
+    return event
+
+  def load(self):
+    for table in self.NAME_TABLES:
+      data[table] = {}
+    for table, id, name in self.connection.execute('SELECT "table", id, name FROM names'):
+      data[table][id] = name
+    query = f'SELECT {self.COLUMNS} FROM events ORDER BY id'
+    data['events'] = events.EventStore(map(self.from_row, self.connection.execute(query)))
+    row = self.connection.execute("SELECT value FROM meta WHERE key = 'snapshot'").fetchone()
+    return None if row is None else row[0]
+
+  # Returns the saved events of the channel along with the user states of its
+  # users in all other channels, which decide how they are displayed. They're
+  # looked up through the indices on channel and user over a connection of its
+  # own, so that it can be done from any thread.
+  def get_history(self, channel):
+    connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+    try:
+      query = f'''
+        SELECT {self.COLUMNS} FROM events
+        WHERE channel = ? OR (type = 'user_state' AND user IN (SELECT DISTINCT user FROM events WHERE channel = ?))
+        ORDER BY id
+      '''
+      return list(map(self.from_row, connection.execute(query, (channel, channel))))
+    finally:
+      connection.close()
+
+  def replay(self):
+    return 0
+
+  def is_due(self):
+    if self.is_cache_deferred and cleaning is None:
+      return True
+    return time.monotonic() - last_compaction >= parse_duration(config['compaction'])
+
+  def append(self, records):
+    logging.info(f'Writing {len(records)} records to the database')
+    with self.connection:
+      self.connection.execute('BEGIN')
+      for kind, *args in records:
+        if kind == 'event':
+          self.connection.execute('INSERT INTO events VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self.to_row(args[0]))
+        elif kind == 'edit':
+          message, content = args
+          self.connection.execute("UPDATE events SET extra = json_set(coalesce(extra, '{}'), '$.content', ?) WHERE message = ?", (content, message))
+        elif kind == 'delete':
+          self.connection.execute('DELETE FROM events WHERE message = ?', args)
+          self.connection.execute("DELETE FROM meta WHERE key = 'snapshot'")
+        elif kind == 'name':
+          self.connection.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?)', args)
+        else:
+          raise Exception(f'Unknown record kind: {repr(kind)}')
+
+  # The cache has to be built from the same events as are in the table, so while
+  # there are deleted comments left, they're cleaned in the background and only
+  # the records are written. The cache is then written by the next save after
+  # the cleaning has finished.
+  def take_snapshot(self, records):
+    if data['events'].tombstonec() > 0:
+      start_cleaning()
+      self.is_cache_deferred = True
+      return Snapshot(records, with_cache=False)
+    self.is_cache_deferred = False
+    return Snapshot(records)
+
+  def compact(self, snapshot):
+    self.append(snapshot.records)
+    if snapshot.cache is None:
+      return
+    write_cache(snapshot.cache)
+    with self.connection:
+      self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('snapshot', ?)", (snapshot.id,))
+    self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+  def rewrite(self):
+    # Nothing else goes on during a rewrite, so the deleted comments might as
+    # well be cleaned right away, and the cache written along with the events.
+    if data['events'].tombstonec() > 0:
+      clean()
+    with self.connection:
+      self.connection.execute('BEGIN')
+      self.connection.execute('DELETE FROM events')
+      self.connection.execute('DELETE FROM names')
+      self.connection.execute("DELETE FROM meta WHERE key = 'snapshot'")
+      self.connection.executemany('INSERT INTO events VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (self.to_row(event) for event in data['events'] if event is not None))
+      for table in self.NAME_TABLES:
+        self.connection.executemany('INSERT INTO names VALUES (?, ?, ?)', ((table, id, name) for id, name in data[table].items()))
+    self.compact(self.take_snapshot([]))
+
+  def close(self):
+    self.connection.close()
+
+# The segment storage keeps the events of every finished period of time in an
+# immutable segment file, which is memory-mapped instead of being read in, and
+# only the events of the current period in memory. Everything else is kept in an
+# index file. Like in the JSON storage, the records in between compactions are
+# appended to a journal. Segments are never overwritten, and only the new index
+# points to the new ones, so a crash during compaction leaves the old ones
+# intact. Only the events themselves are kept out of memory this way. The
+# per-channel event indices and the meetings still cover the whole history,
+# though the meetings are restored from the cache instead of being rebuilt by
+# decoding every segment on startup.
+class SegmentStorage(JsonStorage):
+  VERSION = 1
+
+  def index_path(self):
+    return os.path.join(self.path, 'index')
+
+  def journal_path(self):
+    return os.path.join(self.path, 'journal')
+
+  @staticmethod
+  def get_period(micros):
+    time = events.to_datetime(micros, 0)
+    return (time.year * 12 + time.month - 1) // config['segment_months']
+
+  @staticmethod
+  def get_period_begin(period):
+    year, month = divmod(period * config['segment_months'], 12)
+    return events.to_micros(datetime(year, month + 1, 1, tzinfo=timezone.utc))
+
+  def load(self):
+    events.Segment.cache_size = config['segment_cache']
+    try:
+      with open(self.index_path(), 'rb') as file:
+        index = marshal.load(file)
+    except FileNotFoundError:
+      return None
+    if index['version'] != self.VERSION:
+      raise Exception(f'Unsupported segment storage version: {repr(index["version"])}')
+    data.update(index['tables'])
+
+    store = events.EventStore()
+    for name, values in index['interned'].items():
+      interned = getattr(store, name)
+      interned.values = values
+      interned.codes = {value: code for code, value in enumerate(values)}
+    for name in index['segments']:
+      store.add_segment(events.Segment(os.path.join(self.path, name), store.base))
+    active = events.Segment(os.path.join(self.path, index['active']), store.base)
+    for name, code in events.COLUMNS:
+      store.active(name).extend(active.copy_column(name))
+    store.extras = active.extras
+    store.count_tombstones()
+    events.Segment.decoded.pop(active, None)
+    data['events'] = store
+    self.snapshot = index['snapshot']
+    return self.snapshot
+
+  # Compaction changes the segments of the events in place, so it's all done
+  # under the lock, but it only writes out what has changed.
+  def take_snapshot(self, records):
+    return records
+
+  def compact(self, records):
+    with lock:
+      self.write_segments()
+
+  def write_segments(self):
+    # A cleaning would still use the segments from before.
+    if cleaning is not None:
+      clean()
+    os.makedirs(self.path, exist_ok=True)
+    store = data['events']
+    snapshot = str(uuid.uuid4())
+
+    def write(prefix, columns, extras):
+      name = f'{prefix}.{snapshot[:8]}.segment'
+      events.Segment.write(os.path.join(self.path, name), columns, extras)
+      return name
+
+    for segment in store.segments:
+      if segment.is_dirty:
+        columns = {name: segment.copy_column(name) for name, code in events.COLUMNS}
+        name = write(os.path.basename(segment.path).partition('.')[0], columns, segment.extras)
+        store.replace_segment(segment, events.Segment(os.path.join(self.path, name), segment.start))
+
+    # Everything before the current period is sealed away.
+    period = self.get_period(events.to_micros(datetime.now().astimezone()))
+    end = bisect_left(store.time, self.get_period_begin(period), lo=store.base)
+    while store.base < end:
+      begin = store.base
+      period = self.get_period(store.time[begin])
+      until = min(bisect_left(store.time, self.get_period_begin(period + 1), lo=begin), end)
+      year, month = divmod(period * config['segment_months'], 12)
+      name = write(f'{year:04}-{month + 1:02}-{begin}', *store.active_slice(begin, until))
+      store.add_segment(events.Segment(os.path.join(self.path, name), begin))
+    active = write('active', *store.active_slice(store.base, len(store)))
+
+    index = {
+      'version': self.VERSION,
+      'snapshot': snapshot,
+      'tables': {key: value for key, value in data.items() if key not in CACHE_KEYS and key != 'events'},
+      'interned': {name: getattr(store, name).values for name in ['ids', 'types', 'causes', 'flags']},
+      'segments': [os.path.basename(segment.path) for segment in store.segments],
+      'active': active,
+    }
+    replace_file(self.index_path(), lambda file: marshal.dump(index, file))
+    save_cache(snapshot)
+    self.snapshot = snapshot
+
+    if os.path.exists(self.journal_path()):
+      os.remove(self.journal_path())
+    for name in os.listdir(self.path):
+      if name.endswith('.segment') and name not in index['segments'] and name != active:
+        os.remove(os.path.join(self.path, name))
+
+  def get_segments(self):
+    store = data['events']
+    result = []
+    for segment in store.segments:
+      result.append({
+        'name': os.path.basename(segment.path),
+        'events': segment.count,
+        'bytes': os.path.getsize(segment.path),
+        'state': 'decoded' if segment.is_decoded() else 'mapped',
+        'dirty': segment.is_dirty,
+      })
+    result.append({'name': 'active', 'events': len(store) - store.base, 'state': 'in memory'})
+    return result
+
+# Returns the number of bytes taken up by all the files of the database.
+def disk_usage():
+  result = 0
+  directory = os.path.dirname(config['database']) or '.'
+  for name in os.listdir(directory):
+    if name.startswith(os.path.basename(config['database'])):
+      path = os.path.join(directory, name)
+      if os.path.isdir(path):
+        result += sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+      else:
+        result += os.path.getsize(path)
+  return result
+
+STORAGES = {'json': JsonStorage, 'binary': BinaryStorage, 'sqlite': SqliteStorage, 'segments': SegmentStorage}
+storage = None
+
+def open_storage():
+  global storage
+  if storage is not None:
+    storage.close()
+  if config['storage'] not in STORAGES:
+    raise Exception(f'Unknown database storage: {repr(config["storage"])}')
+  storage = STORAGES[config['storage']](config['database'])
 
+@stats.timed('database.load')
+def load(source=None):
+  logging.info('Loading database')
+  start = time.perf_counter()
+  with save_lock, lock:
+    global should_save, should_compact, last_compaction, generation
+    if source is None:
+      open_storage()
+      source = storage
+    generation += 1
+    pending.clear()
+    reset_cache()
+    snapshot = source.load()
+    should_save = False
+
+    load_cache(snapshot)
+    recachedc = len(data['events']) - data['cache_eventc']
+    update_cache()
+    logging.info(f'Cached {recachedc} out of {len(data["events"])} events')
+
+    recordc = source.replay()
+    if recordc > 0:
+      logging.info(f'Replayed {recordc} journal records')
+    # We don't want to waste our time replaying the same records again on the
+    # next startup.
+    should_save = should_compact = recordc > 0
+    pending.clear()
+    last_compaction = time.monotonic()
+  logging.info(f'Loaded database in {time.perf_counter() - start:.3f} seconds')
+
+def replay(entry):
+  kind, *args = entry
+  if kind == 'event':
+    data['events'].append(args[0])
+    update_cache()
+  elif kind == 'edit':
+    edit_comment(*args, should_record=False)
+  elif kind == 'delete':
+    delete_comment(*args, should_record=False)
+  elif kind == 'name':
+    set_name(*args, should_record=False)
+  else:
+    raise Exception(f'Unknown journal record kind: {repr(kind)}')
+
+# Saves only take what they need from the database under the lock and write it
+# out without holding it, so they are serialized with a lock of their own.
+save_lock = threading.RLock()
+
+# This is called under the lock.
+def take_pending():
+  global should_save
+  records = pending.copy()
+  pending.clear()
+  should_save = False
+  return records
+
+# Puts the records back in front of the ones added since, so that they are
+# saved again next time.
+def restore_pending(records):
+  with lock:
+    pending[:0] = records
+    global should_save
+    should_save = True
+
+@stats.timed('database.save')
 def save():
+  with save_lock:
+    with lock:
+      if storage is None:
+        open_storage()
+      is_compaction = should_compact or storage.is_due()
+      if not is_compaction:
+        records = take_pending()
+    # Compactions take their own snapshot under the lock and write it out
+    # without it.
+    if is_compaction:
+      return compact()
+    try:
+      storage.append(records)
+    except:
+      restore_pending(records)
+      raise
+    global last_save
+    last_save = time.monotonic()
+
+@stats.timed('database.compact')
+def compact():
   logging.info('Saving database')
-  with lock:
-    if os.path.exists(config['database']):
-      os.replace(config['database'], config['database'] + '.old')
-
-    class Encoder(json.JSONEncoder):
-      def default(self, value):
-        if isinstance(value, set):
-          result = {'__set__': True}
-          for item in value:
-            result[item] = None
-          return result
-        return json.JSONEncoder.default(self, value)
-    with open(config['database'], 'x') as file:
-      json.dump(data, file, cls=Encoder)
+  with save_lock:
+    start = time.perf_counter_ns()
+    with lock:
+      if storage is None:
+        open_storage()
+      records = take_pending()
+      snapshot = storage.take_snapshot(records)
+      global should_compact
+      should_compact = False
+    middle = time.perf_counter_ns()
+    try:
+      storage.compact(snapshot)
+    except:
+      restore_pending(records)
+      should_compact = True
+      raise
+    end = time.perf_counter_ns()
+    if config['stats']:
+      stats.record('database.compact.snapshot', middle - start)
+      stats.record('database.compact.write', end - middle)
+    logging.info(f'Saved database in {(end - start) / 1e9:.3f} seconds, {(middle - start) / 1e9:.3f} of which under the lock')
 
-    global should_save
-    should_save = False
+    global last_save, last_compaction
+    last_save = last_compaction = time.monotonic()
+
+# Writes the database out in JSON, which is easy to look into, without
+# changing where it's saved.
+def export_json(path):
+  with save_lock:
+    export = JsonStorage(path)
+    with lock:
+      snapshot = export.take_snapshot([])
+    export.write(snapshot)
+
+# Copies a database saved with the JSON storage into the current storage.
+def import_json(path):
+  with save_lock, lock:
+    open_storage()
+    load(JsonStorage(path))
+    storage.rewrite()
+    pending.clear()
+    global should_save, should_compact
+    should_save = should_compact = False
+  return f'Imported {len(data["events"])} events from {path}'
 
 autosave_thread = None
 autosave_stop = None
+writer_thread = None
 
 def start():
   global autosave_thread, autosave_stop
@@ -98,6 +824,10 @@ def start():
 
   load()
 
+  global writer_thread
+  writer_thread = threading.Thread(target=write)
+  writer_thread.start()
+
   autosave_stop = threading.Event()
   def autosave():
     autosave_stop.clear()
@@ -105,6 +835,8 @@ def start():
       autosave_stop.wait(timeout=parse_duration(config['autosave']))
       if should_save:
         save()
+      if data['events'].tombstonec() >= config['clean_threshold']:
+        start_cleaning()
   autosave_thread = threading.Thread(target=autosave)
   autosave_thread.start()
 
@@ -114,64 +846,237 @@ def stop():
     raise Exception('The database is already stopped')
   logging.info('Stopping database')
 
+  # The writer goes first, so that the last save includes everything it wrote.
+  global writer_thread
+  writes.put(None)
+  writer_thread.join()
+  writer_thread = None
+
   autosave_stop.set()
   autosave_thread.join()
   autosave_stop = None
   autosave_thread = None
 
+# Deleted comments leave tombstones behind, which are removed by copying the
+# remaining events into a new store a chunk at a time, so that the lock is never
+# held for long. Events deleted in the meantime are deleted from the copy too.
+class Cleaning:
+  def __init__(self):
+    self.old = data['events']
+    self.new = self.old.empty_copy()
+    self.remap = events.Remap(self.old.base)
+    self.removedc = 0
+
+cleaning = None
+cleaning_thread = None
+cleaning_stats = {'runs': 0, 'removed_events': 0, 'reclaimed_bytes': 0}
+
+# Returns whether the cleaning is finished.
+def clean_step():
+  global cleaning
+  with lock:
+    if cleaning is None:
+      cleaning = Cleaning()
+    elif cleaning.old is not data['events']: # The database has been reloaded.
+      cleaning = None
+      return True
+
+    begin = len(cleaning.remap)
+    end = min(begin + config['clean_chunk'], len(cleaning.old))
+    cleaning.removedc += cleaning.old.copy_to(cleaning.new, begin, end, cleaning.remap)
+    if end < len(cleaning.old):
+      return False
+
+    data['events'], remap = cleaning.new, cleaning.remap
+    # Tombstones only ever replace comments, which don't affect the rest of the
+    # cache, so we only have to fix up the event indices.
+    old_eventc = data['cache_eventc']
+    new_eventc = len(data['events'])
+    for i in range(old_eventc, len(remap)):
+      if remap[i] != events.MISSING:
+        new_eventc = remap[i]
+        break
+    data['cache_eventc'] = new_eventc
+    data['message_to_event'] = {message: remap[i] for message, i in data['message_to_event'].items() if remap[i] != events.MISSING}
+    for key in INDEX_KEYS:
+      if data[key] is not None:
+        data[key] = {id: array('q', (remap[i] for i in indices if remap[i] != events.MISSING)) for id, indices in data[key].items()}
+
+    global remapc
+    remapc += 1
+    for listener in remap_listeners:
+      listener(old_eventc, new_eventc)
+
+    cleaning_stats['runs'] += 1
+    cleaning_stats['removed_events'] += cleaning.removedc
+    cleaning_stats['reclaimed_bytes'] += cleaning.removedc * events.ROW_SIZE
+    logging.info(f'Removed {cleaning.removedc} deleted comments from the database')
+    cleaning = None
+
+    global should_save
+    should_save = True
+    return True
+
 def clean():
   with lock:
-    events = data['events']
-    data['events'] = []
-    for event in events:
-      if event is not None:
-        data['events'].append(event)
+    while not clean_step():
+      pass
+    global should_compact
+    should_compact = True
+
+def start_cleaning():
+  global cleaning_thread
+  if cleaning_thread is not None and cleaning_thread.is_alive():
+    return
+  def run():
+    while not clean_step():
+      time.sleep(0) # Let the other threads have the lock for a moment.
+  cleaning_thread = threading.Thread(target=run, daemon=True)
+  cleaning_thread.start()
+
+def cleaning_progress():
+  with lock:
+    result = {'running': cleaning is not None, 'tombstones': data['events'].tombstonec()}
+    if cleaning is not None:
+      result['copied'] = len(cleaning.remap)
+      result['total'] = len(cleaning.old)
+    result.update(cleaning_stats)
+    return result
 
+def reset_cache():
+  with lock:
     data['active_users'] = {}
     data['available_channels'] = {}
     data['message_to_event'] = {}
     data['user_last_comment_times'] = {}
     data['user_states'] = {}
+    data['channel_events'] = {}
+    data['user_state_events'] = None
     data['cache_eventc'] = 0
-    update_cache()
-
-    global should_save
-    should_save = True
 
 class Throttled(Exception):
   pass
 
+def stamp_event(event, now):
+  result = {'time': events.to_micros(now), 'utcoffset': int(now.utcoffset().total_seconds())}
+  result.update(event)
+  return result
+
+# Returns whether the event changes anything, raising Throttled for comments
+# which came too soon after the last one.
+def check_event(event, user_states, user_last_comment_times):
+  if event['type'] == 'user_state' and event['user'] in user_states and event['value'] == user_states[event['user']]:
+    return False
+  elif event['type'] == 'comment' and event['user'] in user_last_comment_times:
+    cooldown = parse_duration(config['comment_cooldown']) * 1_000_000
+    if event['time'] - user_last_comment_times[event['user']] < cooldown:
+      raise Throttled()
+  return True
+
+def append_event(event):
+  data['events'].append(event)
+  record('event', event)
+  stats.count('events.' + event['type'])
+
+@stats.timed('database.add_event')
 def add_event(event):
-  old = event
-  event = {'time': datetime.now().astimezone().isoformat()}
-  event.update(old)
+  event = stamp_event(event, datetime.now().astimezone())
 
   with lock:
-    if event['type'] == 'user_state' and event['user'] in data['user_states'] and event['value'] == data['user_states'][event['user']]:
+    if not check_event(event, data['user_states'], data['user_last_comment_times']):
       return
-    elif event['type'] == 'comment' and event['user'] in data['user_last_comment_times']:
-      time = datetime.fromisoformat(event['time'])
-      last_comment = datetime.fromisoformat(data['user_last_comment_times'][event['user']])
-      cooldown = parse_duration(config['comment_cooldown'])
-      if (time - last_comment).total_seconds() < cooldown:
-        raise Throttled()
-
-    data['events'].append(event)
+
+    append_event(event)
     global should_save
     should_save = True
     update_cache()
 
   log_event(event)
 
+# Adds the events in order, all with the same timestamp, under a single
+# acquisition of the lock and with a single update of the caches. Throttled
+# comments and user states which don't change anything are skipped. Returns the
+# list of the events which were actually added.
+@stats.timed('database.add_events')
+def add_events(batch, now=None):
+  if now is None:
+    now = datetime.now().astimezone()
+  batch = [stamp_event(event, now) for event in batch]
+
+  added = []
+  with lock:
+    # The caches are only updated at the end, so the changes made by the batch
+    # itself have to be tracked on the side.
+    user_states = ChainMap({}, data['user_states'])
+    user_last_comment_times = ChainMap({}, data['user_last_comment_times'])
+    throttledc = 0
+    for event in batch:
+      try:
+        if not check_event(event, user_states, user_last_comment_times):
+          continue
+      except Throttled:
+        throttledc += 1
+        continue
+
+      append_event(event)
+      added.append(event)
+      if event['type'] == 'user_state':
+        user_states[event['user']] = event['value']
+      elif event['type'] == 'comment':
+        user_last_comment_times[event['user']] = event['time']
+
+    if added:
+      global should_save
+      should_save = True
+      update_cache()
+
+  if len(added) == 1:
+    log_event(added[0])
+  elif added:
+    typec = {}
+    for event in added:
+      typec[event['type']] = typec.get(event['type'], 0) + 1
+    logging.info(f'Added {len(added)} events: ' + ', '.join(f'{n} {type}' for type, n in sorted(typec.items())))
+  if throttledc > 0:
+    logging.info(f'Skipped {throttledc} throttled comments')
+
+  return added
+
+# The user state events are only needed to merge in the events of other
+# partitions, so they're only indexed once they're first asked for.
+def get_user_state_events():
+  with lock:
+    if data['user_state_events'] is None:
+      result = {}
+      events = data['events']
+      code = events.types.codes.get('user_state', None)
+      for i in range(data['cache_eventc']):
+        if events.type[i] == code:
+          result.setdefault(events.ids.value(events.user[i]), array('q')).append(i)
+      data['user_state_events'] = result
+    return data['user_state_events']
+
+@stats.timed('database.update_cache')
 def update_cache():
   with lock:
     # This assumes that events in the database are in chronological order.
     i = data['cache_eventc']
     while i < len(data['events']):
       event = data['events'][i]
-      if event is None:
+      if event is None: # Tombstones only have to be passed on to the listeners.
+        for listener in cache_listeners:
+          listener(i, event)
+        data['cache_eventc'] += 1
+        i += 1
         continue
 
+      # These let the reports skip over events from other channels.
+      data['channel_events'].setdefault(event['channel'], array('q')).append(i)
+      if event['type'] == 'user_state' and data['user_state_events'] is not None:
+        data['user_state_events'].setdefault(event['user'], array('q')).append(i)
+      if event['type'] in {'join', 'leave', 'comment', 'user_state'}:
+        channel_versions[event['channel']] = channel_versions.get(event['channel'], 0) + 1
+
       if event['type'] in {'join', 'leave'}:
         guild, channel, user = event['guild'], event['channel'], event['user']
         if event['type'] == 'join':
@@ -193,6 +1098,9 @@ def update_cache():
       elif event['type'] == 'user_state':
         data['user_states'][event['user']] = event['value']
 
+      for listener in cache_listeners:
+        listener(i, event)
+
       data['cache_eventc'] += 1
       i += 1
 
@@ -231,37 +1139,118 @@ def log_event(event):
   else:
     raise Exception(f'Unknown event type: {repr(event["type"])}')
 
-def delete_comment(message):
+# Comments can be missing from the events while still being in the cache when
+# the cache was saved along with a database written while they were deleted.
+def get_comment_index(message):
+  i = data['message_to_event'].get(message, None)
+  if i is None or i < 0 or data['events'][i] is None:
+    return None
+  return i
+
+def delete_comment(message, should_record=True):
   with lock:
-    if message not in data['message_to_event']:
+    if get_comment_index(message) is None:
+      data['message_to_event'].pop(message, None)
       return
-    event = data['events'][data['message_to_event'][message]]
-    data['events'][data['message_to_event'][message]] = None
+    event = data['events'][data['message_to_event'][message]].copy()
+    i = data['message_to_event'][message]
+    data['events'][i] = None
+    if cleaning is not None and i < len(cleaning.remap):
+      cleaning.new[cleaning.remap[i]] = None
     del data['message_to_event'][message]
+    channel_versions[event['channel']] = channel_versions.get(event['channel'], 0) + 1
     global should_save
     should_save = True
 
-    event['type'] = '_delete_comment'
-    log_event(event)
+    if should_record:
+      record('delete', message)
+      event['type'] = '_delete_comment'
+      log_event(event)
 
-def edit_comment(message, content):
+def edit_comment(message, content, should_record=True):
   with lock:
-    if message not in data['message_to_event']:
+    if get_comment_index(message) is None:
       return
     event = data['events'][data['message_to_event'][message]]
     event['content'] = content
+    channel_versions[event['channel']] = channel_versions.get(event['channel'], 0) + 1
     global should_save
     should_save = True
 
-    event = event.copy()
-    event['type'] = '_edit_comment'
-    log_event(event)
+    if should_record:
+      record('edit', message, content)
+      event = event.copy()
+      event['type'] = '_edit_comment'
+      log_event(event)
+
+def set_name(table, id, name, should_record=True):
+  with lock:
+    if data[table].get(id, None) == name:
+      return
+    data[table][id] = name
+    if should_record:
+      record('name', table, id, name)
+    global should_save
+    should_save = True
+
+# Everything that the bot changes in the database goes through a queue to a
+# single writer thread, so that the event loop never waits for the lock while a
+# save or a report is holding it. Events are timestamped when they are
+# submitted, so their times don't depend on how long they wait in the queue.
+writes = queue.Queue()
+
+def submit(func, *args):
+  future = Future()
+  writes.put((func, args, future, time.perf_counter_ns()))
+  return future
+
+def submit_event(event):
+  return submit(add_event, stamp_event(event, datetime.now().astimezone()))
+
+def submit_events(batch):
+  now = datetime.now().astimezone()
+  return submit(add_events, [stamp_event(event, now) for event in batch])
+
+def write():
+  should_stop = False
+  while not should_stop:
+    items = [writes.get()]
+    # Whatever has piled up in the meantime is written under a single
+    # acquisition of the lock.
+    while items[-1] is not None:
+      try:
+        items.append(writes.get_nowait())
+      except queue.Empty:
+        break
+    if items[-1] is None:
+      items.pop()
+      should_stop = True
+
+    with lock:
+      for func, args, future, submitted in items:
+        if config['stats']:
+          stats.record('database.write.wait', time.perf_counter_ns() - submitted)
+        try:
+          future.set_result(func(*args))
+        except Throttled as e:
+          future.set_exception(e)
+        except Exception as e:
+          logging.exception('Got exception while writing to the database')
+          future.set_exception(e)
 
 console.begin('database')
-console.register('data',  None, 'prints the database',              lambda: data)
-console.register('load',  None, 'loads the database from file',     load)
-console.register('save',  None, 'saves the database to file',       save)
-console.register('start', None, 'starts the database',              start)
-console.register('stop',  None, 'stops the database',               stop)
-console.register('clean', None, 'cleans and recaches the database', clean)
+console.register('data',    None, 'prints the database',                                lambda: data)
+console.register('load',    None, 'loads the database from file',                       load)
+console.register('save',    None, 'saves the database to file',                         save)
+console.register('compact', None, 'rewrites the database file and empties the journal', compact)
+console.register('import',  '<path>', 'imports a database saved in JSON into the current storage', import_json)
+console.register('export',  '<path>', 'exports the database to a file in JSON', export_json)
+console.register('start',   None, 'starts the database',                                start)
+console.register('stop',    None, 'stops the database',                                 stop)
+console.register('clean',   None, 'cleans the database of deleted comments',           clean)
+console.register('cleaning', None, 'shows the progress of cleaning in the background',  cleaning_progress)
+console.register('clean.start', None, 'starts cleaning the database in the background', start_cleaning)
+console.register('segments', None, 'lists the segments of the database with their sizes and states', lambda: storage.get_segments() if isinstance(storage, SegmentStorage) else 'The database isn\'t kept in segments')
+console.register('writes',  None, 'prints the number of changes waiting for the writer', lambda: writes.qsize())
+console.register('memory',  None, 'compares the memory taken up by events with a list of dicts', lambda: events.memory_usage(data['events']))
 console.end()
@@ -0,0 +1,525 @@
+# Discord voice channel observer bot
+# Copyright (C) 2022 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import marshal, mmap, os, random, struct, sys
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from copy import copy
+from collections.abc import Mapping
+from datetime import datetime, timedelta, timezone
+
+# Events used to be kept as a list of dicts, which costs several hundred bytes
+# per event. Here they are stored column by column in arrays instead, with all
+# the Discord IDs, event types, causes and voice state flags interned into small
+# integers, and with the rare extra fields (like a comment's message and
+# content) kept aside in a separate table. Rows are handed out as lightweight
+# views which behave like the old dicts.
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+TOMBSTONE = 255
+MISSING = -1
+
+class Interned:
+  def __init__(self):
+    self.values = []
+    self.codes = {}
+
+  def code(self, value):
+    if value is None:
+      return MISSING
+    if value not in self.codes:
+      self.codes[value] = len(self.values)
+      self.values.append(value)
+    return self.codes[value]
+
+  def value(self, code):
+    return None if code == MISSING else self.values[code]
+
+def to_micros(time):
+  return (time - EPOCH) // timedelta(microseconds=1)
+
+def parse_isoformat(time):
+  time = datetime.fromisoformat(time)
+  return to_micros(time), int(time.utcoffset().total_seconds())
+
+def to_datetime(micros, utcoffset):
+  return (EPOCH + timedelta(microseconds=micros)).astimezone(timezone(timedelta(seconds=utcoffset)))
+
+COLUMNS = [
+  ('type', 'B'),
+  ('guild', 'i'),
+  ('channel', 'i'),
+  ('user', 'i'),
+  ('time', 'q'),
+  ('offset', 'i'),
+  ('value', 'h'),
+  ('cause', 'h'),
+  ('extra', 'i'),
+]
+# The number of bytes taken up by an event in the columns, without its extra
+# fields.
+ROW_SIZE = sum(array(code).itemsize for name, code in COLUMNS)
+
+FIELDS = ['time', 'utcoffset', 'type', 'guild', 'channel', 'user', 'value', 'cause']
+
+class Row(Mapping):
+  __slots__ = ('store', 'index')
+
+  def __init__(self, store, index):
+    self.store = store
+    self.index = index
+
+  def __getitem__(self, key):
+    store, i = self.store, self.index
+    if key == 'type':
+      return store.types.values[store.type[i]]
+    elif key in {'guild', 'channel', 'user'}:
+      result = store.ids.value(getattr(store, key)[i])
+    elif key == 'time':
+      return store.time[i]
+    elif key == 'utcoffset':
+      return store.offset[i]
+    elif key == 'value':
+      mask = store.value[i]
+      if mask == MISSING:
+        raise KeyError(key)
+      return {flag for j, flag in enumerate(store.flags.values) if mask >> j & 1}
+    elif key == 'cause':
+      result = store.causes.value(store.cause[i])
+    else:
+      fields = store.fields(i)
+      if fields is None:
+        raise KeyError(key)
+      return fields[key]
+    if result is None:
+      raise KeyError(key)
+    return result
+
+  def __setitem__(self, key, value):
+    fields = self.store.fields(self.index)
+    if key in FIELDS or fields is None or key not in fields:
+      raise KeyError(f'Only existing extra fields of an event can be changed: {repr(key)}')
+    fields[key] = value
+    self.store.touch(self.index)
+
+  def __iter__(self):
+    store, i = self.store, self.index
+    yield 'time'
+    yield 'utcoffset'
+    yield 'type'
+    for key in ['guild', 'channel', 'user']:
+      if getattr(store, key)[i] != MISSING:
+        yield key
+    if store.value[i] != MISSING:
+      yield 'value'
+    if store.cause[i] != MISSING:
+      yield 'cause'
+    if store.extra[i] != MISSING:
+      yield from store.fields(i)
+
+  def __len__(self):
+    return sum(1 for key in self)
+
+  def __repr__(self):
+    return repr(dict(self))
+
+  def copy(self):
+    return dict(self)
+
+# Segments are immutable files holding the columns of a range of older events,
+# which are memory-mapped, so that they are only read in by the operating system
+# as they are used, and the extra fields of which are only decoded when needed.
+# Changes made to a segment, like deleting a comment, are only kept in memory
+# until the segment is written again. The file starts with the magic and the
+# number of events, after which come the columns, each aligned to 8 bytes, and
+# the marshalled list of extra fields.
+class Segment:
+  MAGIC = b'VCOBSEG1'
+  HEADER = struct.Struct('<8sQ')
+  # The decoded extra fields of the least recently used segments are dropped
+  # when there are more than this many.
+  cache_size = 4
+  decoded = OrderedDict()
+
+  def __init__(self, path, start):
+    self.path = path
+    self.start = start
+    with open(path, 'rb') as file:
+      self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    magic, self.count = self.HEADER.unpack_from(self.mmap)
+    if magic != self.MAGIC:
+      raise Exception(f'Not a segment file: {repr(path)}')
+    self.columns = {}
+    offset = self.HEADER.size
+    view = memoryview(self.mmap)
+    for name, code in COLUMNS:
+      size = self.count * array(code).itemsize
+      self.columns[name] = view[offset:offset + size].cast(code)
+      offset += -size % 8 + size
+    self.extras_offset = offset
+    self._extras = None
+    self.is_dirty = False
+
+  @staticmethod
+  def write(path, columns, extras):
+    with open(path, 'wb') as file:
+      file.write(Segment.HEADER.pack(Segment.MAGIC, len(columns['type'])))
+      for name, code in COLUMNS:
+        data = columns[name].tobytes()
+        file.write(data)
+        file.write(bytes(-len(data) % 8))
+      marshal.dump(extras, file)
+      file.flush()
+      os.fsync(file.fileno())
+
+  @property
+  def extras(self):
+    if self._extras is None:
+      self._extras = marshal.loads(self.mmap[self.extras_offset:])
+    extras = self._extras
+    Segment.decoded[self] = None
+    Segment.decoded.move_to_end(self)
+    clean = [segment for segment in Segment.decoded if not segment.is_dirty and segment is not self]
+    for segment in clean[:max(len(Segment.decoded) - Segment.cache_size, 0)]:
+      segment._extras = None
+      del Segment.decoded[segment]
+    return extras
+
+  def copy_column(self, name):
+    result = array(self.columns[name].format)
+    result.frombytes(self.columns[name].cast('B'))
+    return result
+
+  def is_decoded(self):
+    return self._extras is not None
+
+# A column of a store with segments, which chains together the columns of the
+# segments and the array of the events after them.
+class Column:
+  __slots__ = ('parts', 'starts', 'base', 'active')
+
+  def __init__(self, parts, starts, base, active):
+    self.parts = parts
+    self.starts = starts
+    self.base = base
+    self.active = active
+
+  def __len__(self):
+    return self.base + len(self.active)
+
+  def __getitem__(self, index):
+    if index >= self.base:
+      return self.active[index - self.base]
+    if index < 0:
+      return self.active[index] if -index <= len(self.active) else self[index + len(self)]
+    j = bisect_right(self.starts, index) - 1
+    return self.parts[j][index - self.starts[j]]
+
+  def __setitem__(self, index, value):
+    if index >= self.base:
+      self.active[index - self.base] = value
+      return
+    j = bisect_right(self.starts, index) - 1
+    self.parts[j][index - self.starts[j]] = value
+
+  def append(self, value):
+    self.active.append(value)
+
+class EventStore:
+  def __init__(self, events=()):
+    for name, code in COLUMNS:
+      setattr(self, name, array(code))
+    self.extras = []
+
+    # The events before base are kept in segments, while the extras only
+    # belong to the events after them.
+    self.segments = []
+    self.base = 0
+    # The tombstones after the segments are counted as they come, so that they
+    # don't have to be counted by going through all the events.
+    self.active_tombstonec = 0
+
+    self.ids = Interned()
+    self.types = Interned()
+    self.causes = Interned()
+    self.flags = Interned()
+
+    for event in events:
+      self.append(event)
+
+  def append(self, event):
+    if event is None:
+      self.append_tombstone()
+      return
+
+    type = self.types.code(event['type'])
+    if type >= TOMBSTONE:
+      raise Exception(f'Too many event types: {repr(event["type"])}')
+    self.type.append(type)
+    self.guild.append(self.ids.code(event.get('guild', None)))
+    self.channel.append(self.ids.code(event.get('channel', None)))
+    self.user.append(self.ids.code(event.get('user', None)))
+    if isinstance(event['time'], str): # Databases used to store times as ISO 8601 strings.
+      micros, utcoffset = parse_isoformat(event['time'])
+    else:
+      micros, utcoffset = event['time'], event['utcoffset']
+    self.time.append(micros)
+    self.offset.append(utcoffset)
+
+    if 'value' in event:
+      mask = 0
+      for flag in event['value']:
+        mask |= 1 << self.flags.code(flag)
+      if mask >= 1 << 15:
+        raise Exception(f'Too many voice state flags: {repr(event["value"])}')
+      self.value.append(mask)
+    else:
+      self.value.append(MISSING)
+    self.cause.append(self.causes.code(event.get('cause', None)))
+
+    extra = {key: value for key, value in event.items() if key not in FIELDS}
+    if extra:
+      self.extra.append(len(self.extras))
+      self.extras.append(extra)
+    else:
+      self.extra.append(MISSING)
+
+  # Tombstones keep the time of the event before them, so that the times stay
+  # sorted.
+  def append_tombstone(self):
+    self.type.append(TOMBSTONE)
+    self.active_tombstonec += 1
+    for column in [self.guild, self.channel, self.user, self.value, self.cause, self.extra]:
+      column.append(MISSING)
+    self.time.append(self.time[-1] if len(self.time) else 0)
+    self.offset.append(self.offset[-1] if len(self.offset) else 0)
+
+  def active(self, name):
+    column = getattr(self, name)
+    return column.active if isinstance(column, Column) else column
+
+  def segment_of(self, index):
+    return self.segments[bisect_right(self.segments, index, key=lambda segment: segment.start) - 1]
+
+  # Returns the extra fields of an event or None if it doesn't have any.
+  def fields(self, index):
+    extra = self.extra[index]
+    if extra == MISSING:
+      return None
+    elif index >= self.base:
+      return self.extras[extra]
+    else:
+      segment = self.segment_of(index)
+      return segment.extras[extra]
+
+  # This has to be called after changing the extra fields of an event.
+  def touch(self, index):
+    if index < self.base:
+      self.segment_of(index).is_dirty = True
+
+  def rechain(self):
+    starts = [segment.start for segment in self.segments]
+    for name, code in COLUMNS:
+      active = self.active(name)
+      if self.segments:
+        setattr(self, name, Column([segment.columns[name] for segment in self.segments], starts, self.base, active))
+      else:
+        setattr(self, name, active)
+
+  # Adds a segment holding the events right after the last segment, which
+  # replaces them if they're already in the store.
+  def add_segment(self, segment):
+    if segment.start != self.base:
+      raise Exception('Segments have to be added in order')
+    self.active_tombstonec -= self.active('type')[:segment.count].count(TOMBSTONE)
+    for name, code in COLUMNS:
+      del self.active(name)[:segment.count]
+    if len(self.extras) > 0:
+      # The extras of the remaining events have to be numbered from zero again.
+      extra = self.active('extra')
+      extras = []
+      for i in range(len(extra)):
+        if extra[i] != MISSING:
+          extras.append(self.extras[extra[i]])
+          extra[i] = len(extras) - 1
+      self.extras = extras
+    self.segments.append(segment)
+    self.base += segment.count
+    self.rechain()
+
+  # Replaces a segment with another one holding the same events, after it has
+  # been written again. The old one is left to be unmapped once nothing uses it.
+  def replace_segment(self, old, new):
+    self.segments[self.segments.index(old)] = new
+    self.rechain()
+    Segment.decoded.pop(old, None)
+
+  # Returns the columns and extra fields of the active events in [begin, end),
+  # ready to be written as a segment.
+  def active_slice(self, begin, end):
+    columns = {name: self.active(name)[begin - self.base:end - self.base] for name, code in COLUMNS}
+    extras = []
+    extra = columns['extra']
+    for i in range(len(extra)):
+      if extra[i] != MISSING:
+        extras.append(self.extras[extra[i]])
+        extra[i] = len(extras) - 1
+    return columns, extras
+
+  # Returns a copy which shares everything with this store but what deleting
+  # and editing events changes, so that the events in it stay the same while
+  # this one goes on changing. Edits only ever replace the extra fields, so
+  # copying their dicts is enough. Stores with segments are copied whole.
+  def frozen_copy(self):
+    if self.base > 0:
+      return EventStore(self)
+    result = copy(self)
+    result.type = self.type[:]
+    result.extra = self.extra[:]
+    result.extras = [None if extra is None else extra.copy() for extra in self.extras]
+    return result
+
+  # Returns an empty store which shares its interned values and segments with
+  # this one.
+  def empty_copy(self):
+    result = EventStore()
+    result.ids, result.types, result.causes, result.flags = self.ids, self.types, self.causes, self.flags
+    result.segments = self.segments.copy()
+    result.base = self.base
+    result.rechain()
+    return result
+
+  # Appends the events in [begin, end) other than tombstones to the other store,
+  # and the new index of each one to remap, with MISSING for removed events.
+  # Returns the number of removed events.
+  def copy_to(self, other, begin, end, remap):
+    removedc = 0
+    columns = [name for name, code in COLUMNS if name != 'extra']
+    for i in range(begin, end):
+      if self.type[i] == TOMBSTONE:
+        remap.append(MISSING)
+        removedc += 1
+        continue
+      remap.append(len(other))
+      for name in columns:
+        getattr(other, name).append(getattr(self, name)[i])
+      if self.extra[i] == MISSING:
+        other.extra.append(MISSING)
+      else:
+        other.extra.append(len(other.extras))
+        other.extras.append(self.fields(i))
+    return removedc
+
+  # Returns a copy of the store without tombstones after its segments and an
+  # array mapping old event indices to new ones. Both stores share their
+  # interned values and segments.
+  def without_tombstones(self):
+    result = self.empty_copy()
+    remap = Remap(self.base)
+    self.copy_to(result, self.base, len(self), remap)
+    return result, remap
+
+  # Only the tombstones after the segments can be removed.
+  def tombstonec(self):
+    return self.active_tombstonec
+
+  # This has to be called after filling in the columns by hand.
+  def count_tombstones(self):
+    self.active_tombstonec = self.active('type').count(TOMBSTONE)
+
+  def __len__(self):
+    return len(self.type)
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('event index out of range')
+    if self.type[index] == TOMBSTONE:
+      return None
+    return Row(self, index)
+
+  def __setitem__(self, index, value):
+    if value is not None:
+      raise Exception('Events can only be replaced with tombstones')
+    if index < 0:
+      index += len(self)
+    if index >= self.base and self.type[index] != TOMBSTONE:
+      self.active_tombstonec += 1
+    self.type[index] = TOMBSTONE
+    if self.extra[index] != MISSING:
+      if index >= self.base:
+        self.extras[self.extra[index]] = None
+      else:
+        segment = self.segment_of(index)
+        segment.extras[self.extra[index]] = None
+      self.extra[index] = MISSING
+    self.touch(index)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def __repr__(self):
+    return repr(list(self))
+
+# Maps old event indices to new ones, where the ones before the offset stay the
+# same.
+class Remap:
+  def __init__(self, offset):
+    self.offset = offset
+    self.array = array('q')
+
+  def __len__(self):
+    return self.offset + len(self.array)
+
+  def __getitem__(self, index):
+    return index if index < self.offset else self.array[index - self.offset]
+
+  def append(self, index):
+    self.array.append(index)
+
+def deep_sizeof(value, seen=None):
+  if seen is None:
+    seen = set()
+  if id(value) in seen:
+    return 0
+  seen.add(id(value))
+  result = sys.getsizeof(value)
+  if isinstance(value, dict):
+    for key, item in value.items():
+      result += deep_sizeof(key, seen) + deep_sizeof(item, seen)
+  elif isinstance(value, (list, tuple, set)):
+    for item in value:
+      result += deep_sizeof(item, seen)
+  return result
+
+# Returns the number of bytes taken up by the store and an estimate for the
+# same events kept as a list of dicts, based on a random sample of them.
+def memory_usage(store, samplec=1000):
+  columnar = sum(sys.getsizeof(store.active(name)) for name, code in COLUMNS)
+  columnar += deep_sizeof(store.extras) + deep_sizeof(store.ids.values) + deep_sizeof(store.ids.codes)
+
+  # The keys of the dicts are shared between events by the JSON decoder, while
+  # their values are not.
+  indices = random.sample(range(len(store)), min(samplec, len(store)))
+  sample = [dict(store[i]) for i in indices if store[i] is not None]
+  dicts = sys.getsizeof([None] * len(store))
+  if sample:
+    total = sum(sys.getsizeof(event) + sum(deep_sizeof(value) for value in event.values()) for event in sample)
+    dicts += total * len(store) // len(indices)
+  return {'columnar': columnar, 'dicts': dicts}
@@ -17,7 +17,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import discord, sys
-import bot, common, console, database
+import bot, common, console, database, metrics, report
 from common import options
 
 if __name__ == '__main__':
@@ -37,12 +37,15 @@ if __name__ == '__main__':
   discord.utils.setup_logging()
   common.load_config()
   console.start()
+  metrics.start()
   database.start()
 
   bot.run()
+  report.stop_pools()
 
   try: # The database may already have been stopped by the console.
     database.stop()
   except:
     pass
+  metrics.stop()
   console.stop()
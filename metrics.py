@@ -0,0 +1,137 @@
+# Discord voice channel observer bot
+# Copyright (C) 2022 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging, math, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bot, database, stats
+from common import config
+
+# The metrics are served over HTTP in the Prometheus text format. Everything is
+# read without the database lock, except for the number of events and
+# tombstones, which are only copied under it, and the active users, which are
+# counted under it.
+
+server = None
+thread = None
+
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Writer:
+  def __init__(self):
+    self.lines = []
+
+  def metric(self, name, type, help, samples):
+    self.lines.append(f'# HELP vcobot_{name} {help}')
+    self.lines.append(f'# TYPE vcobot_{name} {type}')
+    for suffix, labels, value in samples:
+      labels = ','.join(f'{key}="{escape(item)}"' for key, item in labels.items())
+      self.lines.append(f'vcobot_{name}{suffix}{{{labels}}} {value}' if labels else f'vcobot_{name}{suffix} {value}')
+
+  def summary(self, name, help, histograms):
+    samples = []
+    for labels, histogram in histograms:
+      for quantile in [0.5, 0.9, 0.99]:
+        samples.append(('', labels | {'quantile': quantile}, histogram.percentile(quantile * 100) / 1e9))
+      samples.append(('_sum', labels, histogram.total / 1e9))
+      samples.append(('_count', labels, histogram.count))
+    self.metric(name, 'summary', help, samples)
+
+  def text(self):
+    return '\n'.join(self.lines) + '\n'
+
+def collect():
+  writer = Writer()
+
+  counters = stats.counters.copy()
+  histograms = {name: histogram.copy() for name, histogram in stats.histograms.copy().items()}
+  writer.metric('events_added_total', 'counter', 'Number of events added since the statistics were reset', [
+    ('', {'type': name.removeprefix('events.')}, n) for name, n in sorted(counters.items()) if name.startswith('events.')
+  ])
+  writer.metric('counter_total', 'counter', 'Other counters of the bot', [
+    ('', {'name': name}, n) for name, n in sorted(counters.items()) if not name.startswith('events.')
+  ])
+  writer.summary('latency_seconds', 'Latencies of operations of the bot', [
+    ({'operation': name}, histogram) for name, histogram in sorted(histograms.items()) if histogram.count > 0
+  ])
+
+  with database.lock:
+    eventc = len(database.data['events'])
+    tombstonec = database.data['events'].active_tombstonec
+  writer.metric('events', 'gauge', 'Number of events in the database', [('', {}, eventc)])
+  writer.metric('tombstones', 'gauge', 'Number of deleted comments waiting to be cleaned from the database', [('', {}, tombstonec)])
+  writer.metric('database_bytes', 'gauge', 'Size of the database files', [('', {}, database.disk_usage())])
+
+  with database.lock:
+    active_users = {guild: sum(len(users) for users in channels.values()) for guild, channels in database.data['active_users'].items()}
+  writer.metric('active_users', 'gauge', 'Number of users in voice channels', [
+    ('', {'guild': guild}, n) for guild, n in sorted(active_users.items())
+  ])
+
+  if database.last_save is not None:
+    writer.metric('seconds_since_save', 'gauge', 'Time since the database was last saved', [('', {}, time.monotonic() - database.last_save)])
+
+  client = bot.client
+  if client is not None and client.is_ready():
+    if isinstance(client, bot.ShardedClient):
+      samples = [('', {'shard': shard}, latency) for shard, latency in client.latencies if math.isfinite(latency)]
+    else:
+      samples = [('', {}, client.latency)] if math.isfinite(client.latency) else []
+    writer.metric('gateway_latency_seconds', 'gauge', 'Latency between a heartbeat and its acknowledgement from the Discord gateway', samples)
+
+  return writer.text()
+
+class Handler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path != '/metrics':
+      self.send_error(404)
+      return
+    try:
+      body = collect().encode()
+    except Exception:
+      logging.exception('Got exception while collecting metrics')
+      self.send_error(500)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug(f'Metrics request from {self.address_string()}: {format % args}')
+
+def start():
+  if config['metrics_port'] is None:
+    return
+  global server, thread
+  server = ThreadingHTTPServer((config['metrics_host'], config['metrics_port']), Handler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever)
+  thread.start()
+  logging.info(f'Started metrics endpoint on {config["metrics_host"]}:{config["metrics_port"]}')
+
+def stop():
+  global server, thread
+  if server is None:
+    return
+  logging.info('Stopping metrics endpoint')
+  server.shutdown()
+  server.server_close()
+  thread.join()
+  server = None
+  thread = None
@@ -0,0 +1,96 @@
+# Discord voice channel observer bot
+# Copyright (C) 2022 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq, json, logging, os, sqlite3
+
+import database
+from common import config
+
+# When the shards of the bot are split between processes, every process saves
+# the events of its own guilds in its own database, called a partition. The
+# events of a channel can still end up in more than one partition after the
+# shards have been rearranged, so reports merge in the events from the
+# partitions of the other processes. Those are read from their SQLite
+# databases, which can be read by other programs while they're being written,
+# and only include what the other processes have saved so far.
+
+# The partitions which have failed, so that they're only warned about once.
+failed = set()
+
+# Returns the rows returned by the query from every partition which could be
+# read.
+def query(sql, args=()):
+  result = []
+  for path in config['partitions']:
+    try:
+      connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+      try:
+        result.append(connection.execute(sql, args).fetchall())
+      finally:
+        connection.close()
+      failed.discard(path)
+    except sqlite3.Error as e:
+      if path not in failed:
+        logging.warning(f'Failed to read partition {repr(path)}: {e}')
+        failed.add(path)
+  return result
+
+# Merges the events returned by the query from all partitions in chronological
+# order.
+def get_events(sql, args):
+  rows = query(f'SELECT {database.SqliteStorage.COLUMNS} FROM events WHERE {sql} ORDER BY id', args)
+  return list(heapq.merge(*[map(database.SqliteStorage.from_row, part) for part in rows], key=lambda event: event['time']))
+
+def get_channel_events(channel, begin=None, end=None):
+  sql = 'channel = ?'
+  args = [channel]
+  if begin is not None:
+    sql += ' AND time >= ?'
+    args.append(begin)
+  if end is not None:
+    sql += ' AND time <= ?'
+    args.append(end)
+  return get_events(sql, args)
+
+# Returns the users with events in the channel in any partition.
+def get_users(channel):
+  result = set()
+  for part in query('SELECT DISTINCT user FROM events WHERE channel = ? AND user IS NOT NULL', (channel,)):
+    result.update(user for user, in part)
+  return result
+
+# Returns the events of the channel along with the user states of the given
+# users in all other channels, which decide how they are displayed.
+def get_history(channel, users):
+  return get_events("channel = ? OR (type = 'user_state' AND user IN (SELECT value FROM json_each(?)))", (channel, json.dumps(sorted(users))))
+
+def get_name(table, id):
+  for part in query('SELECT name FROM names WHERE "table" = ? AND id = ?', (table, id)):
+    for name, in part:
+      return name
+  return None
+
+# Changes every time one of the partitions is written to, which is what the
+# cached reports are checked against.
+def get_version():
+  result = []
+  for path in config['partitions']:
+    for name in [path, path + '-wal']:
+      try:
+        result.append(os.stat(name).st_mtime_ns)
+      except FileNotFoundError:
+        result.append(None)
+  return tuple(result)
@@ -14,12 +14,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import html, typing as ty
+import atexit, concurrent.futures, gzip, heapq, html, logging, marshal, multiprocessing, os, re, shutil, tempfile, threading, time, typing as ty, zipfile
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from copy import deepcopy
 from datetime import datetime, timedelta
 from dataclasses import dataclass
 
-import console, database
+import console, database, partitions, stats
 from common import config, parse_duration
+from events import to_datetime, to_micros
 
 @dataclass
 class DisplayState:
@@ -34,17 +38,35 @@ class DisplayState:
     self.stream = 'stream' in user_state
     self.video = 'video' in user_state
 
+# Display states are packed into tuples to be saved along with the database
+# cache, and there are only a few of them, so they're shared when unpacked.
+def pack_display_state(state):
+  return (state.mute, state.deafen, state.stream, state.video)
+
+unpacked_display_states = {}
+
+def unpack_display_state(packed):
+  if packed not in unpacked_display_states:
+    result = DisplayState(set())
+    result.mute, result.deafen, result.stream, result.video = packed
+    unpacked_display_states[packed] = result
+  return unpacked_display_states[packed]
+
+# All times are in microseconds since the Unix epoch and are only converted to
+# datetimes when written out in a report.
+
 @dataclass
 class Sub:
-  begin: datetime
-  end: datetime
+  begin: int
+  end: int
   display_state: set[DisplayState]
 
 @dataclass
 class Comment:
-  time: datetime
+  time: int
+  utcoffset: int
   url: str
-  content: str
+  message: int
 
 @dataclass
 class Bar:
@@ -76,164 +98,534 @@ class Column:
 
 @dataclass
 class Meeting:
-  begin: datetime
-  end: datetime
+  begin: int
+  end: int
+  utcoffset: int
   channel: int
   columns: list[Column]
 
-# We really don't care if the database is modified while generating a report
-# and it ends up being corrupted, so we don't lock the database here.
-def get_meetings(channel):
-  result = []
-
-  columns = {}
-  begin_time = None
-  end_time = None
-  open_barc = 0
-
-  def flush():
-    nonlocal columns, open_barc
-
-    if len(columns) >= int(config['meeting_userc']):
-      columns = list(columns.values())
-
-      nonlocal end_time
-      if open_barc > 0:
-        end_time = datetime.now().astimezone()
+def pack_column(column):
+  return (column.user, column.name, [(
+    bar.is_open,
+    [(sub.begin, sub.end, pack_display_state(sub.display_state)) for sub in bar.subs],
+    [(comment.time, comment.utcoffset, comment.url, comment.message) for comment in bar.comments],
+  ) for bar in column.bars])
+
+def unpack_column(packed):
+  user, name, bars = packed
+  return Column(user, name, [Bar(
+    is_open,
+    [Sub(begin, end, unpack_display_state(display_state)) for begin, end, display_state in subs],
+    [Comment(*comment) for comment in comments],
+  ) for is_open, subs, comments in bars])
+
+# Closed meetings are packed into their beginning, end and the rest marshalled,
+# so that they can be left packed until a report needs them.
+def pack_meeting(meeting):
+  columns = [pack_column(column) for column in meeting.columns]
+  return (meeting.begin, meeting.end, marshal.dumps((meeting.utcoffset, meeting.channel, columns)))
+
+def unpack_meeting(packed):
+  begin, end, rest = packed
+  utcoffset, channel, columns = marshal.loads(rest)
+  return Meeting(begin, end, utcoffset, channel, [unpack_column(column) for column in columns])
+
+def sort_columns(columns):
+  def key(column):
+    result = 0
+    for bar in column.bars:
+      for sub in bar.subs:
+        result += sub.end - sub.begin
+    return result
+  columns.sort(key=key, reverse=True)
+
+# Meetings are built incrementally as the database caches new events. Closed
+# meetings never change again, so only the last meeting in every channel is
+# kept open for modification.
+class ChannelMeetings:
+  def __init__(self, channel, interval, userc):
+    self.channel = channel
+    self.interval = interval
+    self.userc = userc
+    self.closed = []
+    self.columns = {}
+    self.utcoffset = None
+    self.begin_time = None
+    self.end_time = None
+    self.open_barc = 0
+    # Closed meetings never change, so they're only packed once. Restored
+    # ones stay packed in closed until they're needed.
+    self.packed = []
+
+  def pack(self):
+    self.packed.extend(meeting if isinstance(meeting, tuple) else pack_meeting(meeting) for meeting in self.closed[len(self.packed):])
+    columns = {user: pack_column(column) for user, column in self.columns.items()}
+    return (self.packed, columns, self.utcoffset, self.begin_time, self.end_time, self.open_barc)
+
+  @classmethod
+  def unpack(cls, channel, interval, userc, packed):
+    result = cls(channel, interval, userc)
+    result.packed, columns, result.utcoffset, result.begin_time, result.end_time, result.open_barc = packed
+    result.closed = result.packed.copy()
+    result.columns = {user: unpack_column(column) for user, column in columns.items()}
+    return result
+
+  def flush(self):
+    if len(self.columns) >= self.userc:
+      columns = list(self.columns.values())
+      sort_columns(columns)
+      self.closed.append(Meeting(self.begin_time, self.end_time, self.utcoffset, self.channel, columns))
+    self.columns = {}
+    self.open_barc = 0
+
+  def consume(self, event, display_state):
+    time = event['time']
+    if not self.columns or (self.open_barc == 0 and time - self.end_time >= self.interval):
+      self.flush()
+      self.utcoffset = event['utcoffset']
+      self.begin_time = time
+      self.end_time = time
+
+    type, user = event['type'], event['user']
+    if type == 'join':
+      if user not in self.columns:
+        self.columns[user] = Column(user, str(user), [])
+      self.columns[user].bars.append(Bar(True, [Sub(time, None, display_state)], []))
+      self.open_barc += 1
+    elif user not in self.columns:
+      # This can only happen when a meeting starts with something else than a
+      # join, which means that the database is missing some events.
+      pass
+    elif type == 'leave':
+      self.columns[user].bars[-1].is_open = False
+      self.columns[user].bars[-1].end = time
+      self.open_barc -= 1
+    elif type == 'comment':
+      url = f'https://discord.com/channels/{event["guild"]}/{event["message_channel"]}/{event["message"]}'
+      self.columns[user].bars[-1].comments.append(Comment(time, event['utcoffset'], url, event['message']))
+    elif type == 'user_state':
+      if self.columns[user].bars[-1].end is None:
+        self.columns[user].bars[-1].subs[-1].end = time
+        self.columns[user].bars[-1].subs.append(Sub(time, None, display_state))
+    self.end_time = time
+
+  # Returns the meetings which overlap with the time between begin and end with
+  # a copy of the open one closed at the current time.
+  def get(self, begin=None, end=None):
+    # Closed meetings don't overlap, so both their beginnings and ends are
+    # sorted.
+    first = 0 if begin is None else bisect_left(self.closed, begin, key=lambda meeting: meeting[1] if isinstance(meeting, tuple) else meeting.end)
+    last = len(self.closed) if end is None else bisect_right(self.closed, end, key=lambda meeting: meeting[0] if isinstance(meeting, tuple) else meeting.begin)
+    for i in range(first, last):
+      if isinstance(self.closed[i], tuple):
+        self.closed[i] = unpack_meeting(self.closed[i])
+    result = self.closed[first:last]
+    if len(self.columns) >= self.userc and (end is None or self.begin_time <= end):
+      columns = deepcopy(list(self.columns.values()))
+      end_time = self.end_time
+      if self.open_barc > 0:
+        end_time = to_micros(datetime.now().astimezone())
       for column in columns:
         if column.bars[-1].end is None:
           column.bars[-1].end = end_time
-
-      def key(column):
-        result = timedelta()
-        for bar in column.bars:
-          for sub in bar.subs:
-            result += sub.end - sub.begin
-        return result
-      columns.sort(key=key, reverse=True)
-
-      nonlocal result
-      result.append(Meeting(begin_time, end_time, channel, columns))
-
-    columns = {}
-    open_barc = 0
-
-  def begin_bar(user, time, display_state):
-    if user not in columns:
-      columns[user] = Column(user, database.data['user_names'].get(user, str(user)), [])
-    columns[user].bars.append(Bar(True, [Sub(time, None, display_state)], []))
-    nonlocal open_barc
-    open_barc += 1
-
-  def end_bar(user, time):
-    columns[user].bars[-1].is_open = False
-    columns[user].bars[-1].end = time
-    nonlocal open_barc
-    open_barc -= 1
-
-  def add_sub(user, time, display_state):
-    columns[user].bars[-1].subs[-1].end = time
-    columns[user].bars[-1].subs.append(Sub(time, None, display_state))
-
-  def add_comment(user, time, url, content):
-    columns[user].bars[-1].comments.append(Comment(time, url, content))
-
-  display_states = {}
-  for event in database.data['events']:
+      sort_columns(columns)
+      if begin is None or end_time >= begin:
+        result.append(Meeting(self.begin_time, end_time, self.utcoffset, self.channel, columns))
+    return result
+
+class Meetings:
+  def __init__(self):
+    self.generation = database.generation
+    self.remapc = database.remapc
+    self.interval = round(parse_duration(config['meeting_interval']) * 1_000_000)
+    self.userc = int(config['meeting_userc'])
+    self.eventc = 0
+    self.channels = {}
+    self.display_states = {}
+
+  def pack(self):
+    channels = {channel: meetings.pack() for channel, meetings in self.channels.items()}
+    display_states = {user: pack_display_state(state) for user, state in self.display_states.items()}
+    return (self.interval, self.userc, self.eventc, channels, display_states)
+
+  @classmethod
+  def unpack(cls, packed):
+    result = cls()
+    result.interval, result.userc, result.eventc, channels, display_states = packed
+    result.channels = {channel: ChannelMeetings.unpack(channel, result.interval, result.userc, meetings) for channel, meetings in channels.items()}
+    result.display_states = {user: unpack_display_state(state) for user, state in display_states.items()}
+    return result
+
+  def is_valid(self):
+    return self.generation == database.generation and \
+           self.interval == round(parse_duration(config['meeting_interval']) * 1_000_000) and \
+           self.userc == int(config['meeting_userc'])
+
+  def consume(self, event):
+    self.eventc += 1
     if event is None:
-      continue
+      return
 
     type = event['type']
     if type == 'user_state':
       new = DisplayState(event['value'])
-      if event['user'] in display_states and new == display_states[event['user']]:
-        continue
-      display_states[event['user']] = new
-
-    if event['channel'] != channel or type not in {'join', 'leave', 'comment', 'user_state'}:
-      continue
-
-    time = datetime.fromisoformat(event['time'])
-    interval = parse_duration(config['meeting_interval'])
-    if not columns or (open_barc == 0 and (time - end_time).total_seconds() >= interval):
-      flush()
-      begin_time = time
-      end_time = time
-
-    user = event['user']
-    if type == 'join':
-      begin_bar(user, time, display_states[user])
-    elif type == 'leave':
-      end_bar(user, time)
-    elif type == 'comment':
-      add_comment(user, time, f'https://discord.com/channels/{event["guild"]}/{event["message_channel"]}/{event["message"]}', event['content'])
-    elif type == 'user_state':
-      if user in columns and columns[user].bars[-1].end is None:
-        add_sub(user, time, display_states[user])
-    end_time = time
-  flush()
+      if event['user'] in self.display_states and new == self.display_states[event['user']]:
+        return
+      self.display_states[event['user']] = new
+
+    if type not in {'join', 'leave', 'comment', 'user_state'}:
+      return
+    channel = event['channel']
+    if channel not in self.channels:
+      self.channels[channel] = ChannelMeetings(channel, self.interval, self.userc)
+    display_state = self.display_states.get(event['user'], None) or DisplayState(set())
+    self.channels[channel].consume(event, display_state)
+
+meetings = None
+rebuild_thread = None
+
+def on_event(i, event):
+  if meetings is not None and meetings.is_valid() and meetings.eventc == i:
+    meetings.consume(event)
+  else:
+    start_rebuild()
+
+def on_remap(old_eventc, new_eventc):
+  if meetings is not None and meetings.eventc == old_eventc:
+    meetings.eventc = new_eventc
+    meetings.remapc = database.remapc
+
+# The meetings are saved along with the database cache, so that they don't have
+# to be rebuilt from all the events on every startup.
+def dump_meetings():
+  if meetings is None or not meetings.is_valid() or meetings.eventc != database.data['cache_eventc']:
+    return None
+  return meetings.pack()
+
+def restore_meetings(packed):
+  global meetings
+  if packed is not None:
+    meetings = Meetings.unpack(packed)
+
+database.cache_extensions['meetings'] = (dump_meetings, restore_meetings)
+
+def start_rebuild():
+  global rebuild_thread
+  with database.lock:
+    if rebuild_thread is not None and rebuild_thread.is_alive():
+      return
+    rebuild_thread = threading.Thread(target=rebuild)
+    rebuild_thread.start()
+
+def rebuild():
+  logging.info('Rebuilding meetings')
+  new = None
+  while True:
+    # We go through the events in chunks so as not to hog the database lock.
+    with database.lock:
+      # Meetings don't refer to events by their indices, so only a rebuild in
+      # progress cares about events being moved around.
+      if new is None or not new.is_valid() or new.remapc != database.remapc:
+        new = Meetings()
+      end = min(new.eventc + 10000, database.data['cache_eventc'])
+      for i in range(new.eventc, end):
+        new.consume(database.data['events'][i])
+      if new.eventc == database.data['cache_eventc']:
+        global meetings
+        meetings = new
+        break
+  logging.info('Finished rebuilding meetings')
+
+def get_name(table, id):
+  name = database.data[table].get(id, None)
+  if name is None and config['partitions']:
+    name = partitions.get_name(table, id)
+  return name
+
+# Builds the meetings of only one channel out of its events and the user states
+# of its users from everywhere else.
+def build_meetings(channel, history, begin=None, end=None):
+  built = Meetings()
+  for event in history:
+    built.consume(event)
+  if channel not in built.channels:
+    return []
+  result = built.channels[channel].get(begin, end)
+  for meeting in result:
+    for column in meeting.columns:
+      column.name = get_name('user_names', column.user) or str(column.user)
+  return result
 
+# Meetings of channels with events in other partitions are built from scratch
+# out of the events of the channel from all of them, along with the user states
+# of its users from everywhere else. Returns them with the contents of the
+# comments from the other partitions.
+def get_merged_meetings(channel, users, begin=None, end=None):
+  with database.lock:
+    events = database.data['events']
+    indices = database.data['channel_events'].get(channel, [])
+    users = users | {events[i]['user'] for i in indices if events[i] is not None and 'user' in events[i]}
+    indices = set(indices)
+    for user in users:
+      indices.update(database.get_user_state_events().get(user, []))
+    local = [events[i].copy() for i in sorted(indices) if events[i] is not None]
+  foreign = partitions.get_history(channel, users)
+
+  comments = {event['message']: event['content'] for event in foreign if event['type'] == 'comment' and event['channel'] == channel}
+  return build_meetings(channel, heapq.merge(local, foreign, key=lambda event: event['time']), begin, end), comments
+
+@stats.timed('report.get_meetings')
+def get_meetings(channel, begin=None, end=None):
+  users = partitions.get_users(channel) if config['partitions'] else set()
+  if users:
+    return get_merged_meetings(channel, users, begin, end)[0]
+
+  if meetings is None or not meetings.is_valid():
+    start_rebuild()
+    # The SQLite storage can look up the history of only this channel, so we
+    # don't have to wait for the meetings of all channels to be rebuilt. The
+    # events which haven't been saved yet are saved first.
+    if isinstance(database.storage, database.SqliteStorage):
+      if database.should_save:
+        database.save()
+      return build_meetings(channel, database.storage.get_history(channel), begin, end)
+    rebuild_thread.join()
+
+  with database.lock:
+    if meetings is None or not meetings.is_valid():
+      raise Exception('Meetings are out of date')
+    if channel not in meetings.channels:
+      return []
+    result = meetings.channels[channel].get(begin, end)
+
+  for meeting in result:
+    for column in meeting.columns:
+      column.name = database.data['user_names'].get(column.user, str(column.user))
   return result
 
-def generate(channel):
-  result = '<!DOCTYPE html>\n'
-  result += '<html lang="en">\n'
-  result += '<head>\n'
-  result += '<meta charset="UTF-8">\n'
-  result += '<meta name="viewport" content="width=device-width, initial-scale=1">\n'
-  with open('report.css', 'r') as style, open('report.js', 'r') as script:
-    result += '<style>\n'
-    result += style.read()
-    result += '</style>\n'
-    result += '<script>\n'
-    result += script.read()
-    result += '</script>\n'
-  result += '</head>\n'
-  result += '<body>\n'
+database.cache_listeners.append(on_event)
+database.remap_listeners.append(on_remap)
+
+def get_comment_content(message):
+  with database.lock:
+    i = database.get_comment_index(message)
+    if i is None:
+      return None
+    return database.data['events'][i]['content']
+
+# Reports are rendered either straight from the database or from a snapshot of
+# everything they need, which can be sent over to another process.
+# Reports can be limited to the time between begin and end, in which case they
+# include all meetings which overlap with it.
+class Source:
+  def __init__(self, channel, begin=None, end=None):
+    self.channel = channel
+    self.begin = begin
+    self.end = end
+    self.guild = get_name('channel_guilds', channel)
+    self.name = get_name('channel_names', channel)
+    # These are the comments from other partitions.
+    self.comments = {}
+
+  def get_meetings(self):
+    begin = None if self.begin is None else to_micros(self.begin)
+    end = None if self.end is None else to_micros(self.end)
+    users = partitions.get_users(self.channel) if config['partitions'] else set()
+    if users:
+      result, self.comments = get_merged_meetings(self.channel, users, begin, end)
+      return result
+    return get_meetings(self.channel, begin, end)
+
+  def get_comment_content(self, message):
+    if message in self.comments:
+      return self.comments[message]
+    return get_comment_content(message)
+
+  # The events are copied out a chunk at a time under the lock, as compactions
+  # and cleanings move them around in between. Every chunk starts from the time
+  # of the last event, skipping the ones at that time which were already read.
+  def get_local_events(self, begin, end):
+    time = begin
+    seenc = 0
+    while True:
+      with database.lock:
+        # Events are in chronological order, so we can look up the ones in our
+        # time range right away.
+        events = database.data['events']
+        indices = database.data['channel_events'].get(self.channel, [])
+        i = 0 if time is None else bisect_left(indices, time, key=lambda i: events.time[i])
+        last = len(indices) if end is None else bisect_right(indices, end, key=lambda i: events.time[i])
+        skipc = seenc
+        chunk = []
+        while i < last and len(chunk) < 1000:
+          event = events[indices[i]]
+          i += 1
+          if event is None:
+            continue
+          if event['time'] == time and skipc > 0:
+            skipc -= 1
+            continue
+          if event['time'] != time:
+            time = event['time']
+            seenc = 0
+          seenc += 1
+          chunk.append(event.copy())
+      yield from chunk
+      if i >= last:
+        break
+
+  def get_events(self):
+    begin = None if self.begin is None else to_micros(self.begin)
+    end = None if self.end is None else to_micros(self.end)
+    local = self.get_local_events(begin, end)
+    if config['partitions']:
+      local = heapq.merge(local, partitions.get_channel_events(self.channel, begin, end), key=lambda event: event['time'])
+    for event in local:
+      yield str(event)
+
+@dataclass
+class Snapshot:
+  channel: int
+  begin: ty.Optional[datetime]
+  end: ty.Optional[datetime]
+  guild: ty.Optional[int]
+  name: ty.Optional[str]
+  meetings: list[Meeting]
+  comments: dict[int, str]
+  events: list[str]
+
+  def get_meetings(self):
+    return self.meetings
+
+  def get_comment_content(self, message):
+    return self.comments.get(message, None)
+
+  def get_events(self):
+    return self.events
+
+def take_snapshot(channel, begin=None, end=None):
+  source = Source(channel, begin, end)
+  meetings = source.get_meetings()
+  comments = {}
+  for meeting in meetings:
+    for column in meeting.columns:
+      for bar in column.bars:
+        for comment in bar.comments:
+          comments[comment.message] = source.get_comment_content(comment.message)
+  return Snapshot(channel, begin, end, source.guild, source.name, meetings, comments, list(source.get_events()))
+
+# The stylesheet and script are read and minified only once, as they are the
+# same in every report.
+assets = {}
+
+def minify_style(style):
+  style = re.sub(r'/\*.*?\*/', '', style, flags=re.DOTALL)
+  style = re.sub(r'\s+', ' ', style)
+  style = re.sub(r' ?([{};,>]) ?', r'\1', style)
+  style = re.sub(r': ', ':', style)
+  return style.replace(';}', '}').strip() + '\n'
+
+# This is deliberately conservative, because the script relies on line breaks
+# in places.
+def minify_script(script):
+  script = re.sub(r'/\*.*?\*/', '', script, flags=re.DOTALL)
+  return ''.join(line.strip() + '\n' for line in script.splitlines() if line.strip())
+
+def load_assets():
+  logging.info('Loading report assets')
+  path = os.path.dirname(os.path.abspath(__file__))
+  with open(os.path.join(path, 'report.css'), 'r') as style, open(os.path.join(path, 'report.js'), 'r') as script:
+    assets['style'] = minify_style(style.read())
+    assets['script'] = minify_script(script.read())
+
+load_assets()
+
+# Every icon is defined once at the top of a report and then referenced.
+ICONS = {
+  'comment': '<path fill="currentColor" d="M4.79805 3C3.80445 3 2.99805 3.8055 2.99805 4.8V15.6C2.99805 16.5936 3.80445 17.4 4.79805 17.4H7.49805V21L11.098 17.4H19.198C20.1925 17.4 20.998 16.5936 20.998 15.6V4.8C20.998 3.8055 20.1925 3 19.198 3H4.79805Z"></path>',
+  'mute': '<path d="M6.7 11H5C5 12.19 5.34 13.3 5.9 14.28L7.13 13.05C6.86 12.43 6.7 11.74 6.7 11Z" fill="currentColor"></path><path d="M9.01 11.085C9.015 11.1125 9.02 11.14 9.02 11.17L15 5.18V5C15 3.34 13.66 2 12 2C10.34 2 9 3.34 9 5V11C9 11.03 9.005 11.0575 9.01 11.085Z" fill="currentColor"></path><path d="M11.7237 16.0927L10.9632 16.8531L10.2533 17.5688C10.4978 17.633 10.747 17.6839 11 17.72V22H13V17.72C16.28 17.23 19 14.41 19 11H17.3C17.3 14 14.76 16.1 12 16.1C11.9076 16.1 11.8155 16.0975 11.7237 16.0927Z" fill="currentColor"></path><path d="M21 4.27L19.73 3L3 19.73L4.27 21L8.46 16.82L9.69 15.58L11.35 13.92L14.99 10.28L21 4.27Z" fill="currentColor"></path>',
+  'deafen': '<path d="M6.16204 15.0065C6.10859 15.0022 6.05455 15 6 15H4V12C4 7.588 7.589 4 12 4C13.4809 4 14.8691 4.40439 16.0599 5.10859L17.5102 3.65835C15.9292 2.61064 14.0346 2 12 2C6.486 2 2 6.485 2 12V19.1685L6.16204 15.0065Z" fill="currentColor"></path><path d="M19.725 9.91686C19.9043 10.5813 20 11.2796 20 12V15H18C16.896 15 16 15.896 16 17V20C16 21.104 16.896 22 18 22H20C21.105 22 22 21.104 22 20V12C22 10.7075 21.7536 9.47149 21.3053 8.33658L19.725 9.91686Z" fill="currentColor"></path><path d="M3.20101 23.6243L1.7868 22.2101L21.5858 2.41113L23 3.82535L3.20101 23.6243Z" fill="currentColor"></path>',
+  'video': '<path fill="currentColor" d="M21.526 8.149C21.231 7.966 20.862 7.951 20.553 8.105L18 9.382V7C18 5.897 17.103 5 16 5H4C2.897 5 2 5.897 2 7V17C2 18.104 2.897 19 4 19H16C17.103 19 18 18.104 18 17V14.618L20.553 15.894C20.694 15.965 20.847 16 21 16C21.183 16 21.365 15.949 21.526 15.851C21.82 15.668 22 15.347 22 15V9C22 8.653 21.82 8.332 21.526 8.149Z"></path>',
+  'stream': '<path fill="currentColor" fill-rule="evenodd" clip-rule="evenodd" d="M2 4.5C2 3.397 2.897 2.5 4 2.5H20C21.103 2.5 22 3.397 22 4.5V15.5C22 16.604 21.103 17.5 20 17.5H13V19.5H17V21.5H7V19.5H11V17.5H4C2.897 17.5 2 16.604 2 15.5V4.5ZM13.2 14.3375V11.6C9.864 11.6 7.668 12.6625 6 15C6.672 11.6625 8.532 8.3375 13.2 7.6625V5L18 9.6625L13.2 14.3375Z"></path>',
+}
+
+ICON_REFS = {name: f'<svg viewBox="0 0 24 24"><use href="#icon-{name}"></use></svg>' for name in ICONS}
+
+def render(source):
+  channel = source.channel
+  yield '<!DOCTYPE html>\n'
+  yield '<html lang="en">\n'
+  yield '<head>\n'
+  yield '<meta charset="UTF-8">\n'
+  yield '<meta name="viewport" content="width=device-width, initial-scale=1">\n'
+  yield '<style>\n'
+  yield assets['style']
+  yield '</style>\n'
+  yield '<script>\n'
+  yield assets['script']
+  yield '</script>\n'
+  yield '</head>\n'
+  yield '<body>\n'
+  yield '<svg style="display: none;">'
+  for name, markup in ICONS.items():
+    yield f'<symbol id="icon-{name}" viewBox="0 0 24 24">{markup}</symbol>'
+  yield '</svg>\n'
 
   url = ''
-  if channel in database.data['channel_guilds']:
-    url = f'https://discord.com/channels/{database.data["channel_guilds"][channel]}/{channel}'
+  if source.guild is not None:
+    url = f'https://discord.com/channels/{source.guild}/{channel}'
   name = channel
-  if channel in database.data['channel_names']:
-    name = f'<q>{html.escape(database.data["channel_names"][channel])}</q>'
-  result += '<div id="all-except-footer">\n'
-  result += '<header>\n'
-  result += f'<h1>Activity report for voice channel <a href="{url}" target="_blank" rel="noopener noreferrer">{name}</a></h1>\n'
-  result += '</header>\n'
-
-  result += '<main id="timeline">\n'
-  result += '<div id="indicator"></div>\n'
-
-  meetings = get_meetings(channel)
+  if source.name is not None:
+    name = f'<q>{html.escape(source.name)}</q>'
+  yield '<div id="all-except-footer">\n'
+  yield '<header>\n'
+  yield f'<h1>Activity report for voice channel <a href="{url}" target="_blank" rel="noopener noreferrer">{name}</a></h1>\n'
+  if source.begin is not None or source.end is not None:
+    begin = 'the beginning'
+    if source.begin is not None:
+      begin = f'<time datetime="{source.begin}" data-timestamp="{source.begin.timestamp()}">{source.begin}</time>'
+    end = 'now'
+    if source.end is not None:
+      end = f'<time datetime="{source.end}" data-timestamp="{source.end.timestamp()}">{source.end}</time>'
+    yield f'<p>This report only covers meetings from {begin} to {end}.</p>\n'
+  yield '</header>\n'
+
+  yield '<main id="timeline">\n'
+  yield '<div id="indicator"></div>\n'
+
+  meetings = source.get_meetings()
   prev_meeting_end = None
   for meeting in meetings:
-    result += f'<div class="meeting-heading" data-begin="{(prev_meeting_end or meeting.begin).timestamp()}" data-end="{meeting.begin.timestamp()}">'
-    result += f'<h2>Meeting on <time datetime="{meeting.begin}" data-timestamp="{meeting.begin.timestamp()}">{meeting.begin}</time></h2>'
-    result += '</div>\n'
+    begin = to_datetime(meeting.begin, meeting.utcoffset)
+    yield f'<div class="meeting-heading" data-begin="{(prev_meeting_end or meeting.begin) / 1_000_000}" data-end="{meeting.begin / 1_000_000}">'
+    yield f'<h2>Meeting on <time datetime="{begin}" data-timestamp="{meeting.begin / 1_000_000}">{begin}</time></h2>'
+    yield '</div>\n'
     prev_meeting_end = meeting.end
 
-    result += f'<div class="meeting" data-begin="{meeting.begin.timestamp()}" data-end="{meeting.end.timestamp()}">\n'
+    yield f'<div class="meeting" data-begin="{meeting.begin / 1_000_000}" data-end="{meeting.end / 1_000_000}">\n'
 
     for i, column in enumerate(meeting.columns):
       hue = i * 360 / len(meeting.columns)
-      result += f'<div class="column" style="--hue: {hue};" title="{html.escape(column.name)}">\n'
+      yield f'<div class="column" style="--hue: {hue};" title="{html.escape(column.name)}">\n'
 
       prev_bar_end = meeting.begin
       for bar in column.bars:
-        offset = (bar.begin - prev_bar_end).total_seconds()
-        result += f'<div class="bar" style="margin-top: {offset}px;">'
+        offset = (bar.begin - prev_bar_end) / 1_000_000
+        yield f'<div class="bar" style="margin-top: {offset}px;">'
         prev_bar_end = bar.end
 
         for comment in bar.comments:
-          offset = (comment.time - bar.begin).total_seconds()
-          result += f'<div class="comment" style="margin-top: {offset}px;" data-timestamp="{comment.time.timestamp()}" title="Commented on {comment.time}">'
-          result += '<svg viewBox="0 0 24 24"><path fill="currentColor" d="M4.79805 3C3.80445 3 2.99805 3.8055 2.99805 4.8V15.6C2.99805 16.5936 3.80445 17.4 4.79805 17.4H7.49805V21L11.098 17.4H19.198C20.1925 17.4 20.998 16.5936 20.998 15.6V4.8C20.998 3.8055 20.1925 3 19.198 3H4.79805Z"></path></svg>'
-          result += f'<a href="{comment.url}" target="_blank" rel="noopener noreferrer">{html.escape(comment.content)}</a>' # TODO: Text formatting
-          result += '</div>'
+          content = source.get_comment_content(comment.message)
+          if content is None:
+            continue
+          offset = (comment.time - bar.begin) / 1_000_000
+          yield f'<div class="comment" style="margin-top: {offset}px;" data-timestamp="{comment.time / 1_000_000}" title="Commented on {to_datetime(comment.time, comment.utcoffset)}">'
+          yield ICON_REFS['comment']
+          yield f'<a href="{comment.url}" target="_blank" rel="noopener noreferrer">{html.escape(content)}</a>' # TODO: Text formatting
+          yield '</div>'
 
         class_ = 'subs open' if bar.is_open else 'subs'
-        result += f'<div class="{class_}">'
+        yield f'<div class="{class_}">'
 
         prev_class = None
         for sub in bar.subs:
@@ -243,44 +635,280 @@ def generate(channel):
             class_ += ' repeated'
           else:
             prev_class = class_
-          height = (sub.end - sub.begin).total_seconds()
-          result += f'<div class="{class_}" style="height: {height}px;">'
+          height = (sub.end - sub.begin) / 1_000_000
+          yield f'<div class="{class_}" style="height: {height}px;">'
 
           if sub.display_state.mute:
-            result += '<div class="user-state-icon" title="Muted"><svg viewBox="0 0 24 24"><path d="M6.7 11H5C5 12.19 5.34 13.3 5.9 14.28L7.13 13.05C6.86 12.43 6.7 11.74 6.7 11Z" fill="currentColor"></path><path d="M9.01 11.085C9.015 11.1125 9.02 11.14 9.02 11.17L15 5.18V5C15 3.34 13.66 2 12 2C10.34 2 9 3.34 9 5V11C9 11.03 9.005 11.0575 9.01 11.085Z" fill="currentColor"></path><path d="M11.7237 16.0927L10.9632 16.8531L10.2533 17.5688C10.4978 17.633 10.747 17.6839 11 17.72V22H13V17.72C16.28 17.23 19 14.41 19 11H17.3C17.3 14 14.76 16.1 12 16.1C11.9076 16.1 11.8155 16.0975 11.7237 16.0927Z" fill="currentColor"></path><path d="M21 4.27L19.73 3L3 19.73L4.27 21L8.46 16.82L9.69 15.58L11.35 13.92L14.99 10.28L21 4.27Z" fill="currentColor"></path></svg></div>'
+            yield f'<div class="user-state-icon" title="Muted">{ICON_REFS["mute"]}</div>'
           if sub.display_state.deafen:
-            result += '<div class="user-state-icon" title="Deafened"><svg viewBox="0 0 24 24"><path d="M6.16204 15.0065C6.10859 15.0022 6.05455 15 6 15H4V12C4 7.588 7.589 4 12 4C13.4809 4 14.8691 4.40439 16.0599 5.10859L17.5102 3.65835C15.9292 2.61064 14.0346 2 12 2C6.486 2 2 6.485 2 12V19.1685L6.16204 15.0065Z" fill="currentColor"></path><path d="M19.725 9.91686C19.9043 10.5813 20 11.2796 20 12V15H18C16.896 15 16 15.896 16 17V20C16 21.104 16.896 22 18 22H20C21.105 22 22 21.104 22 20V12C22 10.7075 21.7536 9.47149 21.3053 8.33658L19.725 9.91686Z" fill="currentColor"></path><path d="M3.20101 23.6243L1.7868 22.2101L21.5858 2.41113L23 3.82535L3.20101 23.6243Z" fill="currentColor"></path></svg></div>'
+            yield f'<div class="user-state-icon" title="Deafened">{ICON_REFS["deafen"]}</div>'
           if sub.display_state.video:
-            result += '<div class="user-state-icon" title="Video"><svg viewBox="0 0 24 24"><path fill="currentColor" d="M21.526 8.149C21.231 7.966 20.862 7.951 20.553 8.105L18 9.382V7C18 5.897 17.103 5 16 5H4C2.897 5 2 5.897 2 7V17C2 18.104 2.897 19 4 19H16C17.103 19 18 18.104 18 17V14.618L20.553 15.894C20.694 15.965 20.847 16 21 16C21.183 16 21.365 15.949 21.526 15.851C21.82 15.668 22 15.347 22 15V9C22 8.653 21.82 8.332 21.526 8.149Z"></path></svg></div>'
+            yield f'<div class="user-state-icon" title="Video">{ICON_REFS["video"]}</div>'
           if sub.display_state.stream:
-            result += '<div class="user-state-icon" title="Streaming"><svg viewBox="0 0 24 24"><path fill="currentColor" fill-rule="evenodd" clip-rule="evenodd" d="M2 4.5C2 3.397 2.897 2.5 4 2.5H20C21.103 2.5 22 3.397 22 4.5V15.5C22 16.604 21.103 17.5 20 17.5H13V19.5H17V21.5H7V19.5H11V17.5H4C2.897 17.5 2 16.604 2 15.5V4.5ZM13.2 14.3375V11.6C9.864 11.6 7.668 12.6625 6 15C6.672 11.6625 8.532 8.3375 13.2 7.6625V5L18 9.6625L13.2 14.3375Z"></path></svg></div>'
-
-          result += '</div>'
-        result += '</div>\n'
-
-        result += '</div>\n'
-      result += '</div>\n'
-    result += '</div>\n'
-  result += '</main>\n'
-  result += '</div>\n'
-
-  result += '<footer>\n'
-  result += '<h2>Raw events</h2>\n'
-  result += '<pre id="raw-events">\n'
-  for event in database.data['events']:
-    if event is not None and event['channel'] == channel:
-      result += str(event) + '\n'
-  result += '</pre>\n'
-  result += '</footer>\n'
-
-  result += '</body>\n'
-  result += '</html>\n'
+            yield f'<div class="user-state-icon" title="Streaming">{ICON_REFS["stream"]}</div>'
+
+          yield '</div>'
+        yield '</div>\n'
+
+        yield '</div>\n'
+      yield '</div>\n'
+    yield '</div>\n'
+  yield '</main>\n'
+  yield '</div>\n'
+
+  yield '<footer>\n'
+  yield '<h2>Raw events</h2>\n'
+  yield '<pre id="raw-events">\n'
+  for event in source.get_events():
+    yield event + '\n'
+  yield '</pre>\n'
+  yield '</footer>\n'
+
+  yield '</body>\n'
+  yield '</html>\n'
+
+@stats.timed('report.generate')
+def generate(channel, file, begin=None, end=None):
+  file.writelines(render(Source(channel, begin, end)))
+
+def generate_snapshot(snapshot, path):
+  with open(path, 'w', encoding='utf-8') as file:
+    file.writelines(render(snapshot))
+
+# Reports are generated in a pool of threads, which may hand off the rendering
+# itself to a pool of processes, so that they don't hold up the bot.
+executor = None
+process_pool = None
+pool_lock = threading.Lock()
+
+def get_executor():
+  global executor
+  with pool_lock:
+    if executor is None:
+      executor = concurrent.futures.ThreadPoolExecutor(int(config['report_workers']), 'report')
+    return executor
+
+@stats.timed('report.write_report')
+def write_report(channel, path, begin=None, end=None):
+  if config['report_pool'] == 'process':
+    global process_pool
+    with pool_lock:
+      if process_pool is None:
+        # Forking with the other threads running could leave locks held forever
+        # in the workers.
+        process_pool = concurrent.futures.ProcessPoolExecutor(int(config['report_workers']), multiprocessing.get_context('spawn'))
+    process_pool.submit(generate_snapshot, take_snapshot(channel, begin, end), path).result()
+  elif config['report_pool'] == 'thread':
+    with open(path, 'w', encoding='utf-8') as file:
+      generate(channel, file, begin, end)
+  else:
+    raise Exception(f'Unknown report pool: {repr(config["report_pool"])}')
+
+def stop_pools():
+  global executor, process_pool
+  with pool_lock:
+    if executor is not None:
+      executor.shutdown()
+      executor = None
+    if process_pool is not None:
+      process_pool.shutdown()
+      process_pool = None
+
+# Finished reports are kept around in files until an event touches their
+# channel or, if they contain a meeting that is still going on, until they get
+# too old.
+cache = OrderedDict()
+cache_dir = None
+cache_size = 0
+cache_hits = 0
+cache_misses = 0
+cache_lock = threading.Lock()
+
+def get_version(channel):
+  result = (database.generation, database.channel_versions.get(channel, 0), config['meeting_interval'], config['meeting_userc'])
+  if config['partitions']:
+    result += partitions.get_version()
   return result
 
+def is_ongoing(channel):
+  with database.lock:
+    return meetings is not None and channel in meetings.channels and meetings.channels[channel].open_barc > 0
+
+def evict(key):
+  global cache_size
+  _, _, path, size = cache.pop(key)
+  os.remove(path)
+  cache_size -= size
+
+# Returns the report opened for reading in binary mode. The file stays readable
+# even if it gets evicted from the cache in the meantime.
+def get_report(channel, begin=None, end=None):
+  global cache_dir, cache_hits, cache_misses
+  key = (channel, begin, end)
+  version = get_version(channel)
+  with cache_lock:
+    if key in cache:
+      cached_version, expiry, path, _ = cache[key]
+      if cached_version == version and (expiry is None or time.monotonic() < expiry):
+        cache.move_to_end(key)
+        cache_hits += 1
+        return open(path, 'rb')
+      evict(key)
+    cache_misses += 1
+    if cache_dir is None:
+      cache_dir = tempfile.mkdtemp(prefix='report-cache-')
+      atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+
+  expiry = None
+  if is_ongoing(channel):
+    expiry = time.monotonic() + parse_duration(config['report_cache_ttl'])
+  fd, path = tempfile.mkstemp(dir=cache_dir, prefix=f'{channel}-', suffix='.html')
+  os.close(fd)
+  try:
+    write_report(channel, path, begin, end)
+  except:
+    os.remove(path)
+    raise
+  result = open(path, 'rb')
+
+  global cache_size
+  with cache_lock:
+    if key in cache:
+      evict(key)
+    size = os.path.getsize(path)
+    cache[key] = (version, expiry, path, size)
+    cache_size += size
+    while cache and cache_size > int(config['report_cache_size']):
+      evict(next(iter(cache)))
+  return result
+
+def compress(report, kind):
+  result = tempfile.TemporaryFile()
+  if kind == 'gzip':
+    with gzip.GzipFile('report.html', 'wb', 6, result) as file:
+      shutil.copyfileobj(report, file)
+  elif kind == 'zip':
+    with zipfile.ZipFile(result, 'w', zipfile.ZIP_DEFLATED) as archive, archive.open('report.html', 'w') as file:
+      shutil.copyfileobj(report, file)
+  else:
+    raise Exception(f'Unknown report compression: {repr(kind)}')
+  result.seek(0)
+  return result
+
+# Times relative to now are rounded down, as otherwise they would be different
+# every time, and so would the keys of the reports in the cache.
+def get_time_ago(seconds, now):
+  timestamp = (now - timedelta(seconds=seconds)).timestamp()
+  rounding = parse_duration(config['report_time_rounding'])
+  if rounding > 0:
+    timestamp -= timestamp % rounding
+  return datetime.fromtimestamp(timestamp, now.tzinfo)
+
+# Returns the report as a file to be uploaded, its name and the time window it
+# was cut down to or None if even the shortest window doesn't fit within limit
+# bytes. Big reports get compressed and, if that's still not enough, cut down to
+# the latest meetings.
+def get_attachment(channel, limit, begin=None, end=None):
+  now = datetime.now().astimezone()
+  for window in [None] + config['report_windows']:
+    window_begin = begin
+    if window is not None:
+      if end is None:
+        window_begin = get_time_ago(parse_duration(window), now)
+      else:
+        window_begin = end - timedelta(seconds=parse_duration(window))
+      if begin is not None and window_begin <= begin:
+        continue
+    report = get_report(channel, window_begin, end)
+    size = os.fstat(report.fileno()).st_size
+    name = 'report.html'
+    if size > int(config['report_compression_threshold']):
+      start = time.perf_counter()
+      with report:
+        report = compress(report, config['report_compression'])
+      compressed_size = os.fstat(report.fileno()).st_size
+      logging.info(f'Compressed report for channel {channel} from {size} to {compressed_size} bytes in {time.perf_counter() - start:.3f} seconds')
+      size = compressed_size
+      name = 'report.html.gz' if config['report_compression'] == 'gzip' else 'report.zip'
+    if size <= limit:
+      return report, name, window
+    report.close()
+  return None
+
+# Dates go first, so that a year on its own isn't taken for seconds ago, and
+# durations need a unit for the same reason.
+def parse_time(string, now):
+  result = None
+  for format in ['%Y', '%Y-%m']:
+    try:
+      result = datetime.strptime(string, format)
+    except ValueError:
+      pass
+  if result is None:
+    try:
+      result = datetime.fromisoformat(string)
+    except ValueError:
+      pass
+  if result is None:
+    if not re.fullmatch(r'(\s*[\d.]+[a-z])+', string):
+      raise Exception(f'Invalid time: {repr(string)}')
+    try:
+      return get_time_ago(parse_duration(string), now)
+    except Exception:
+      raise Exception(f'Invalid time: {repr(string)}')
+  if result.tzinfo is None:
+    result = result.astimezone()
+  return result
+
+# Parses a report's time range, which is either empty, a duration like "7d"
+# covering the time until now or "from <time>", "to <time>" or both, where times
+# are either durations ago or ISO 8601 dates, possibly only a year or a month.
+# Durations are rounded like report windows.
+def parse_range(string):
+  now = datetime.now().astimezone()
+  string = string.strip()
+  if not string:
+    return None, None
+
+  match = re.fullmatch(r'(?:from\s+(.+?))?\s*(?:to\s+(.+))?', string)
+  if match is None or (match[1] is None and match[2] is None):
+    return parse_time(string, now), None
+  begin = None if match[1] is None else parse_time(match[1], now)
+  end = None if match[2] is None else parse_time(match[2], now)
+  if begin is not None and end is not None and begin > end:
+    raise Exception(f'Time range ends before it begins: {repr(string)}')
+  return begin, end
+
 def op_generate(arg):
-  with open('report.html', 'w') as file:
-    file.write(generate(int(arg)))
+  channel, _, time_range = arg.partition(' ')
+  with get_report(int(channel), *parse_range(time_range)) as report, open('report.html', 'wb') as file:
+    shutil.copyfileobj(report, file)
+
+def op_cache_stats():
+  with cache_lock:
+    total = cache_hits + cache_misses
+    return {
+      'reports': len(cache),
+      'size': cache_size,
+      'hits': cache_hits,
+      'misses': cache_misses,
+      'hit_rate': cache_hits / total if total > 0 else None,
+    }
+
+def op_cache_flush():
+  global cache_hits, cache_misses
+  with cache_lock:
+    while cache:
+      evict(next(iter(cache)))
+    cache_hits = 0
+    cache_misses = 0
 
 console.begin('report')
-console.register('generate', '<channel>', 'generates a channel activity report and saves it to report.html', op_generate)
+console.register('generate', '<channel> [range]', 'generates a channel activity report and saves it to report.html', op_generate)
+console.register('reload', None, 'reloads the report stylesheet and script', load_assets)
+console.register('stop_pools', None, 'shuts down the report workers until the next report', stop_pools)
+console.begin('cache')
+console.register('stats', None, 'prints the report cache size and hit rate', op_cache_stats)
+console.register('flush', None, 'empties the report cache',                  op_cache_flush)
+console.end()
 console.end()
@@ -0,0 +1,179 @@
+# Discord voice channel observer bot
+# Copyright (C) 2022 Karol "digitcrusher" Łacina
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import functools, inspect, time
+
+import console
+from common import config
+
+# Latencies are counted in buckets which grow exponentially, with a few of them
+# for every power of two, so that percentiles can be estimated to within about
+# a fifth without keeping every measurement around.
+class Histogram:
+  SUBBUCKETS = 4
+
+  def __init__(self):
+    self.buckets = {}
+    self.count = 0
+    self.total = 0
+    self.max = 0
+
+  @classmethod
+  def bucket(cls, value):
+    length = value.bit_length()
+    if length <= 2:
+      return value
+    return (length - 2) * cls.SUBBUCKETS + (value >> (length - 3) & cls.SUBBUCKETS - 1)
+
+  # Returns the largest value in the bucket.
+  @classmethod
+  def upper_bound(cls, bucket):
+    if bucket < cls.SUBBUCKETS:
+      return bucket
+    length, sub = divmod(bucket, cls.SUBBUCKETS)
+    return ((cls.SUBBUCKETS + sub + 1) << length - 1) - 1
+
+  def add(self, value):
+    bucket = self.bucket(value)
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def copy(self):
+    result = Histogram()
+    result.buckets = self.buckets.copy()
+    result.count, result.total, result.max = self.count, self.total, self.max
+    return result
+
+  def percentile(self, p):
+    if self.count == 0:
+      return None
+    rank = p / 100 * self.count
+    seen = 0
+    for bucket, n in sorted(self.buckets.items()):
+      seen += n
+      if seen >= rank:
+        return min(self.upper_bound(bucket), self.max)
+    return self.max
+
+# Updates from different threads aren't synchronized, so they may very rarely
+# be lost, which is fine for statistics and a lot cheaper than a lock.
+counters = {}
+histograms = {}
+since = time.monotonic()
+
+def count(name, n=1):
+  if config['stats']:
+    counters[name] = counters.get(name, 0) + n
+
+def record(name, nanos):
+  if name not in histograms:
+    histograms[name] = Histogram()
+  histograms[name].add(nanos)
+
+# Records how long the decorated function takes under the given name.
+def timed(name):
+  def decorator(func):
+    if inspect.iscoroutinefunction(func):
+      @functools.wraps(func)
+      async def wrapper(*args, **kwargs):
+        if not config['stats']:
+          return await func(*args, **kwargs)
+        start = time.perf_counter_ns()
+        try:
+          return await func(*args, **kwargs)
+        finally:
+          record(name, time.perf_counter_ns() - start)
+    else:
+      @functools.wraps(func)
+      def wrapper(*args, **kwargs):
+        if not config['stats']:
+          return func(*args, **kwargs)
+        start = time.perf_counter_ns()
+        try:
+          return func(*args, **kwargs)
+        finally:
+          record(name, time.perf_counter_ns() - start)
+    return wrapper
+  return decorator
+
+# A lock which records how long threads wait for it when it's already taken.
+class TimedLock:
+  def __init__(self, lock, name):
+    self.lock = lock
+    self.name = name
+
+  def acquire(self, blocking=True, timeout=-1):
+    if not config['stats']:
+      return self.lock.acquire(blocking, timeout)
+    elif self.lock.acquire(False):
+      count(self.name + '.uncontended')
+      return True
+    elif not blocking:
+      return False
+    start = time.perf_counter_ns()
+    result = self.lock.acquire(True, timeout)
+    record(self.name + '.wait', time.perf_counter_ns() - start)
+    return result
+
+  def release(self):
+    self.lock.release()
+
+  def __enter__(self):
+    if config['stats']:
+      self.acquire()
+    else:
+      self.lock.acquire()
+    return self
+
+  def __exit__(self, *args):
+    self.lock.release()
+
+def reset():
+  global since
+  counters.clear()
+  histograms.clear()
+  since = time.monotonic()
+
+def summarize(histogram, percentiles=(50, 90, 99)):
+  result = {'count': histogram.count, 'mean': f'{histogram.total / histogram.count / 1e6:.3f}ms'}
+  for p in percentiles:
+    result[f'p{p:g}'] = f'{histogram.percentile(p) / 1e6:.3f}ms'
+  result['max'] = f'{histogram.max / 1e6:.3f}ms'
+  return result
+
+def op_all():
+  elapsed = time.monotonic() - since
+  return {
+    'enabled': config['stats'],
+    'seconds': round(elapsed, 3),
+    'counters': {name: {'count': n, 'rate': f'{n / elapsed:.3f}/s'} for name, n in sorted(counters.items())},
+    'latencies': {name: summarize(histogram) for name, histogram in sorted(histograms.items())},
+  }
+
+def op_percentiles(arg):
+  name, *percentiles = arg.split()
+  if name not in histograms:
+    raise Exception(f'No latencies recorded for {repr(name)}')
+  return summarize(histograms[name], [float(p) for p in percentiles] or [50, 90, 99, 99.9])
+
+console.begin('stats')
+console.register('all',         None,              'prints all counters and latency percentiles',        op_all)
+console.register('percentiles', '<name> [<p>...]', 'prints the given latency percentiles of an operation', op_percentiles)
+console.register('reset',       None,              'resets all counters and latencies',                  reset)
+console.end()